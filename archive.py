@@ -0,0 +1,61 @@
+"""Compressed cold-storage records for finished chat sessions.
+
+When a session reaches its final state or is reset, its transcript is swapped
+out of the hot chats document and stored here as a single archive document:
+summary metadata plus the messages as zlib-compressed JSON. The hot document
+therefore stays small no matter how many sessions a user has had.
+"""
+import json
+import zlib
+from datetime import datetime
+
+from bson import Binary, ObjectId
+
+TRANSCRIPT_ENCODING = "zlib+json"
+
+def compress_transcript(messages: list, level: int = 6) -> bytes:
+    raw = json.dumps(messages, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    return zlib.compress(raw, level)
+
+def decompress_transcript(blob: bytes) -> list:
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+def build_archive_document(session: dict, messages: list, reason: str, ended_at: datetime, level: int = 6) -> dict:
+    """Archive record for `messages`, taken from `session` as it was before the swap.
+
+    `first_message_index` is the position of messages[0] in the user's full
+    transcript, so archived and hot messages can be ordered together.
+    """
+    blob = compress_transcript(messages, level)
+    stored = session.get("message_count", len(session.get("history", [])))
+    return {
+        "user_id": session.get("user_id"),
+        "username": session.get("username"),
+        "session_id": session.get("_id"),
+        "reason": reason,
+        "state": session.get("state"),
+        "mood": session.get("mood"),
+        "issue": session.get("issue"),
+        "turn_count": sum(1 for m in messages if m.get("role") == "user"),
+        "message_count": len(messages),
+        "first_message_index": stored - len(session.get("history", [])),
+        "started_at": session.get("session_started_at") or session.get("created_at"),
+        "ended_at": ended_at,
+        "transcript": Binary(blob),
+        "transcript_encoding": TRANSCRIPT_ENCODING,
+        "compressed_bytes": len(blob),
+    }
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def export_line(document: dict, include_transcript: bool = True) -> str:
+    """One NDJSON line for an archive document, with the transcript decoded."""
+    record = {k: v for k, v in document.items() if k != "transcript"}
+    if include_transcript and "transcript" in document:
+        record["messages"] = decompress_transcript(bytes(document["transcript"]))
+    return json.dumps(record, default=_json_default, ensure_ascii=False) + "\n"
@@ -0,0 +1,101 @@
+"""Benchmark SentimentEngine against NLTK's SentimentIntensityAnalyzer.
+
+Measures single-message latency (cold and memoised) and bulk throughput on a
+synthetic corpus of chat replies, and checks that every mood label matches
+the NLTK compound-score thresholds used by the chatbot.
+
+    python bench_sentiment.py --messages 200000
+"""
+import argparse
+import random
+import statistics
+import time
+
+from sentiment import PackagedSentimentAnalyzer, SentimentEngine, mood_from_compound
+
+SHORT_REPLIES = [
+    "fine", "not good", "okay", "I'm ok", "not great", "good", "bad", "meh",
+    "pretty good actually", "terrible", "so so", "I don't know", "yes", "no",
+]
+
+OPENERS = ["I feel", "Honestly I am", "Lately I've been", "Today I was", "I guess I'm", "My week has been"]
+FILLERS = ["really", "kind of", "very", "not", "never", "so", "a little", "extremely", "barely", "at least"]
+ENDINGS = ["", ".", "!", "!!", "?", "...", " :(", " :)", "?!?"]
+
+def build_corpus(size: int, lexicon_words: list, seed: int = 7) -> list:
+    rnd = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        roll = rnd.random()
+        if roll < 0.3:
+            text = rnd.choice(SHORT_REPLIES)
+        else:
+            words = [rnd.choice(OPENERS)]
+            for _ in range(rnd.randint(1, 12)):
+                if rnd.random() < 0.3:
+                    words.append(rnd.choice(FILLERS))
+                words.append(rnd.choice(lexicon_words))
+                if rnd.random() < 0.1:
+                    words.append("but")
+            text = " ".join(words) + rnd.choice(ENDINGS)
+        if rnd.random() < 0.05:
+            text = text.upper()
+        corpus.append(text)
+    return corpus
+
+def percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def time_each(func, texts: list) -> list:
+    samples = []
+    for text in texts:
+        started = time.perf_counter()
+        func(text)
+        samples.append((time.perf_counter() - started) * 1e6)
+    return samples
+
+def report_latency(name: str, samples: list):
+    print(f"  {name:<28} p50 {statistics.median(samples):8.1f} us   p99 {percentile(samples, 99):8.1f} us")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=100000, help="bulk corpus size")
+    parser.add_argument("--latency-samples", type=int, default=5000, help="messages timed one by one")
+    args = parser.parse_args()
+
+    engine = SentimentEngine()
+    # Stock NLTK polarity_scores(), on the same lexicon
+    nltk_sia = PackagedSentimentAnalyzer(engine.lexicon)
+
+    lexicon_words = sorted(engine.lexicon)
+    corpus = build_corpus(args.messages, lexicon_words)
+    sample = corpus[:args.latency_samples]
+
+    def nltk_mood(text):
+        return mood_from_compound(nltk_sia.polarity_scores(text)["compound"])
+
+    print(f"Single-message latency ({len(sample)} messages)")
+    report_latency("nltk polarity_scores", time_each(nltk_mood, sample))
+    report_latency("engine, no memo", time_each(engine._mood, sample))
+    report_latency("engine, memoised", time_each(engine.mood, sample))
+
+    print(f"Bulk throughput ({len(corpus)} messages)")
+    started = time.perf_counter()
+    expected = [nltk_mood(text) for text in corpus]
+    nltk_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    labels = engine.moods(corpus)
+    engine_seconds = time.perf_counter() - started
+
+    print(f"  {'nltk polarity_scores':<28} {len(corpus) / nltk_seconds:12,.0f} msg/s")
+    print(f"  {'engine moods()':<28} {len(corpus) / engine_seconds:12,.0f} msg/s   ({nltk_seconds / engine_seconds:.1f}x)")
+
+    mismatches = sum(1 for a, b in zip(expected, labels) if a != b)
+    print(f"Label mismatches: {mismatches}")
+    if mismatches:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,544 @@
+"""In-process stand-ins for Gemini and MongoDB, used by the load-test harness.
+
+FakeModel answers generate_content_async() like google.generativeai's
+GenerativeModel, with configurable latency and failure rate.
+InMemoryCollection implements the subset of the Motor collection API that
+main4 uses. install_fakes() swaps them into main4 in place of the real
+clients.
+"""
+import asyncio
+import copy
+import random
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import metrics
+
+# ---------------------------
+# Fake LLM
+# ---------------------------
+class FakeLLMError(Exception):
+    """Injected Gemini failure."""
+
+class LatencyModel:
+    """Samples per-call latency in seconds.
+
+    `distribution` is "fixed", "uniform" (median +/- spread) or "lognormal"
+    (median with `sigma` shape, giving the long tail real providers show).
+    """
+
+    def __init__(self, median_ms: float = 800, distribution: str = "lognormal", sigma: float = 0.5,
+                 spread_ms: float = 0, seed: int = None):
+        self.median_ms = median_ms
+        self.distribution = distribution
+        self.sigma = sigma
+        self.spread_ms = spread_ms
+        self.random = random.Random(seed)
+
+    def sample(self) -> float:
+        if self.distribution == "fixed":
+            ms = self.median_ms
+        elif self.distribution == "uniform":
+            ms = self.random.uniform(self.median_ms - self.spread_ms, self.median_ms + self.spread_ms)
+        elif self.distribution == "lognormal":
+            ms = self.median_ms * self.random.lognormvariate(0, self.sigma)
+        else:
+            raise ValueError(f"Unknown latency distribution: {self.distribution}")
+        return max(0.0, ms) / 1000
+
+class FakeChunk:
+    def __init__(self, text: str):
+        self.text = text
+
+class FakeResponse:
+    """Mimics GenerateContentResponse, including async iteration when streamed."""
+
+    def __init__(self, text: str, chunk_delay: float = 0.0, fail_after: int = None):
+        self.text = text
+        self._chunk_delay = chunk_delay
+        self._fail_after = fail_after
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        words = self.text.split(" ")
+        for i in range(0, len(words), 4):
+            if self._fail_after is not None and i >= self._fail_after:
+                raise FakeLLMError("simulated failure mid-stream")
+            await asyncio.sleep(self._chunk_delay)
+            yield FakeChunk(" ".join(words[i:i + 4]) + " ")
+
+class FakeModel:
+    """Drop-in replacement for the Gemini model used by main4."""
+
+    def __init__(self, latency: LatencyModel = None, failure_rate: float = 0.0,
+                 response_words: int = 60, seed: int = None):
+        self.latency = latency or LatencyModel(seed=seed)
+        self.failure_rate = failure_rate
+        self.response_words = response_words
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.failures = 0
+        self.prompt_chars = 0
+
+    def _reply(self, prompt: str) -> str:
+        filler = ["I", "hear", "how", "heavy", "this", "has", "felt", "for", "you", "and", "it", "makes", "sense"]
+        words = [self.random.choice(filler) for _ in range(self.response_words)]
+        return f"(fake reply to {len(prompt)} prompt chars) " + " ".join(words)
+
+    async def generate_content_async(self, contents, *, stream: bool = False, request_options: dict = None, **kwargs):
+        self.calls += 1
+        self.prompt_chars += len(contents)
+        delay = self.latency.sample()
+        failing = self.random.random() < self.failure_rate
+        if failing:
+            self.failures += 1
+        if stream:
+            # Time to first chunk is a third of the call; the rest is spread over the chunks
+            await asyncio.sleep(delay / 3)
+            chunks = max(1, self.response_words // 4)
+            fail_after = self.random.randint(0, self.response_words - 1) if failing else None
+            return FakeResponse(self._reply(contents), chunk_delay=(2 * delay / 3) / chunks, fail_after=fail_after)
+        await asyncio.sleep(delay)
+        if failing:
+            raise FakeLLMError("simulated Gemini failure")
+        return FakeResponse(self._reply(contents))
+
+# ---------------------------
+# In-memory MongoDB collections
+# ---------------------------
+_MISSING = object()
+
+class InsertOneResult:
+    def __init__(self, inserted_id):
+        self.inserted_id = inserted_id
+
+class UpdateResult:
+    def __init__(self, matched_count, modified_count, upserted_id=None):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.upserted_id = upserted_id
+
+class DeleteResult:
+    def __init__(self, deleted_count):
+        self.deleted_count = deleted_count
+
+def get_field(doc, path):
+    for part in path.split("."):
+        if isinstance(doc, list) and part.isdigit():
+            if int(part) >= len(doc):
+                return _MISSING
+            doc = doc[int(part)]
+            continue
+        if not isinstance(doc, dict) or part not in doc:
+            return _MISSING
+        doc = doc[part]
+    return doc
+
+def _matches_condition(value, condition):
+    if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+        for op, operand in condition.items():
+            if op == "$ne":
+                if (operand is None and value is _MISSING) or value == operand:
+                    return False
+            elif op == "$exists":
+                if (value is not _MISSING) != bool(operand):
+                    return False
+            elif op == "$in":
+                if value is _MISSING or value not in operand:
+                    return False
+            elif op == "$nin":
+                if value is not _MISSING and value in operand:
+                    return False
+            elif op in ("$gt", "$gte", "$lt", "$lte"):
+                if value is _MISSING or value is None:
+                    return False
+                if op == "$gt" and not value > operand:
+                    return False
+                if op == "$gte" and not value >= operand:
+                    return False
+                if op == "$lt" and not value < operand:
+                    return False
+                if op == "$lte" and not value <= operand:
+                    return False
+            else:
+                raise NotImplementedError(f"Query operator {op} is not supported")
+        return True
+    if value is _MISSING:
+        return condition is None
+    return value == condition
+
+def matches(doc: dict, query: dict) -> bool:
+    for key, condition in (query or {}).items():
+        if key == "$or":
+            if not any(matches(doc, sub) for sub in condition):
+                return False
+        elif key == "$and":
+            if not all(matches(doc, sub) for sub in condition):
+                return False
+        elif not _matches_condition(get_field(doc, key), condition):
+            return False
+    return True
+
+def project(doc: dict, projection: dict) -> dict:
+    doc = copy.deepcopy(doc)
+    if not projection:
+        return doc
+    slices = {k: v["$slice"] for k, v in projection.items() if isinstance(v, dict) and "$slice" in v}
+    flags = {k: v for k, v in projection.items() if k not in slices}
+    included = {k for k, v in flags.items() if v and k != "_id"}
+    excluded = {k for k, v in flags.items() if not v}
+    if included:
+        doc = {
+            k: v for k, v in doc.items()
+            if k in included or k in slices or (k == "_id" and "_id" not in excluded)
+        }
+    else:
+        doc = {k: v for k, v in doc.items() if k not in excluded}
+    for key, spec in slices.items():
+        if isinstance(doc.get(key), list):
+            if isinstance(spec, list):
+                skip, limit = spec
+                start = skip if skip >= 0 else max(0, len(doc[key]) + skip)
+                doc[key] = doc[key][start:start + limit]
+            elif spec < 0:
+                doc[key] = doc[key][spec:]
+            else:
+                doc[key] = doc[key][:spec]
+    return doc
+
+def evaluate(expression, doc: dict):
+    """The aggregation expressions the update pipelines in this repo use."""
+    if isinstance(expression, str) and expression.startswith("$"):
+        value = get_field(doc, expression[1:])
+        return None if value is _MISSING else value
+    if isinstance(expression, list):
+        return [evaluate(item, doc) for item in expression]
+    if not isinstance(expression, dict) or len(expression) != 1 or not next(iter(expression)).startswith("$"):
+        return expression
+    op, args = next(iter(expression.items()))
+    if op == "$cond":
+        condition, if_true, if_false = args
+        return evaluate(if_true, doc) if evaluate(condition, doc) else evaluate(if_false, doc)
+    values = evaluate(args, doc)
+    if op == "$ifNull":
+        return next((value for value in values if value is not None), None)
+    if op == "$min":
+        return min(values)
+    if op == "$max":
+        return max(values)
+    if op == "$add":
+        return sum(values[1:], values[0])
+    if op == "$subtract":
+        return values[0] - values[1]
+    if op == "$multiply":
+        result = 1
+        for value in values:
+            result *= value
+        return result
+    if op == "$gte":
+        return values[0] >= values[1]
+    if op == "$size":
+        return len(values)
+    raise NotImplementedError(f"Expression operator {op} is not supported")
+
+def apply_update(doc: dict, update, inserting: bool = False):
+    if isinstance(update, list):
+        # Update pipeline: each stage sees the document as the previous one left it
+        for stage in update:
+            for op, fields in stage.items():
+                if op not in ("$set", "$addFields"):
+                    raise NotImplementedError(f"Pipeline stage {op} is not supported")
+                values = {key: evaluate(expression, doc) for key, expression in fields.items()}
+                doc.update(copy.deepcopy(values))
+        return
+    for op, fields in update.items():
+        if op == "$setOnInsert" and not inserting:
+            continue
+        if op in ("$set", "$setOnInsert"):
+            for key, value in fields.items():
+                doc[key] = copy.deepcopy(value)
+        elif op == "$unset":
+            for key in fields:
+                doc.pop(key, None)
+        elif op == "$inc":
+            for key, value in fields.items():
+                doc[key] = doc.get(key, 0) + value
+        elif op == "$push":
+            for key, value in fields.items():
+                items = doc.setdefault(key, [])
+                if isinstance(value, dict) and "$each" in value:
+                    items.extend(copy.deepcopy(value["$each"]))
+                    if "$slice" in value:
+                        n = value["$slice"]
+                        doc[key] = items[n:] if n < 0 else items[:n]
+                else:
+                    items.append(copy.deepcopy(value))
+        elif op == "$pull":
+            for key, condition in fields.items():
+                if isinstance(doc.get(key), list):
+                    doc[key] = [
+                        item for item in doc[key]
+                        if not (matches(item, condition) if isinstance(condition, dict) else item == condition)
+                    ]
+        else:
+            raise NotImplementedError(f"Update operator {op} is not supported")
+
+def _sort_key(field):
+    def key(doc):
+        value = get_field(doc, field)
+        return (value is _MISSING, value if value is not _MISSING else None)
+    return key
+
+class InMemoryCursor:
+    def __init__(self, docs: list, plan: dict = None):
+        self._docs = docs
+        self._plan = plan or {"stage": "COLLSCAN"}
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key, direction: int = 1):
+        keys = key if isinstance(key, list) else [(key, direction)]
+        for field, field_direction in reversed(keys):
+            self._docs.sort(key=_sort_key(field), reverse=field_direction < 0)
+        return self
+
+    def batch_size(self, n: int):
+        return self
+
+    def skip(self, n: int):
+        self._skip = n
+        return self
+
+    def limit(self, n: int):
+        self._limit = n
+        return self
+
+    def _results(self) -> list:
+        docs = self._docs[self._skip:]
+        return docs[:self._limit] if self._limit else docs
+
+    async def explain(self) -> dict:
+        return {"queryPlanner": {"winningPlan": self._plan}}
+
+    async def to_list(self, length: int = None) -> list:
+        docs = self._results()
+        return docs[:length] if length else docs
+
+    def __aiter__(self):
+        return self._aiter()
+
+    async def _aiter(self):
+        for doc in self._results():
+            yield doc
+
+    def __iter__(self):
+        return iter(self._results())
+
+class InMemoryCollection:
+    """The Motor collection methods main4 relies on, over a Python list."""
+
+    def __init__(self, name: str = "collection"):
+        self.name = name
+        self._docs = []
+        self._indexes = {"_id_": {"key": [("_id", 1)]}}
+        self.operation_counts = {}
+
+    def _count(self, operation: str):
+        # Operations are named after the Mongo command they stand in for
+        self.operation_counts[operation] = self.operation_counts.get(operation, 0) + 1
+        metrics.mongo_commands.inc(operation, "ok")
+
+    def _find(self, query: dict) -> list:
+        return [doc for doc in self._docs if matches(doc, query)]
+
+    def peek(self, query: dict = None, projection: dict = None):
+        """find_one() for harness code; not counted as an operation."""
+        docs = self._find(query)[:1]
+        return project(docs[0], projection) if docs else None
+
+    def _plan(self, query: dict) -> dict:
+        """A winning plan in explain() format: the index whose leading key
+        fields the filter covers best, or a collection scan."""
+        fields = {key for key in (query or {}) if not key.startswith("$")}
+        best, best_prefix = None, 0
+        for name, info in self._indexes.items():
+            prefix = 0
+            for field, _ in info["key"]:
+                if field not in fields:
+                    break
+                prefix += 1
+            if prefix > best_prefix:
+                best, best_prefix = name, prefix
+        if best is None:
+            return {"stage": "COLLSCAN"}
+        stage = "IDHACK" if best == "_id_" else "IXSCAN"
+        return {"stage": "FETCH", "inputStage": {"stage": stage, "indexName": best, "keyPattern": dict(self._indexes[best]["key"])}}
+
+    def _check_unique(self, doc: dict):
+        for name, info in self._indexes.items():
+            if not info.get("unique"):
+                continue
+            key = tuple(get_field(doc, field) for field, _ in info["key"])
+            for other in self._docs:
+                if other is not doc and tuple(get_field(other, field) for field, _ in info["key"]) == key:
+                    raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {name}")
+
+    def _insert(self, doc: dict) -> dict:
+        self._check_unique(doc)
+        self._docs.append(doc)
+        return doc
+
+    def _upsert(self, query: dict, update: dict) -> dict:
+        doc = {k: copy.deepcopy(v) for k, v in query.items() if not k.startswith("$") and not isinstance(v, dict)}
+        doc.setdefault("_id", ObjectId())
+        apply_update(doc, update, inserting=True)
+        return self._insert(doc)
+
+    async def find_one(self, query: dict = None, projection: dict = None):
+        self._count("find")
+        for doc in self._docs:
+            if matches(doc, query):
+                return project(doc, projection)
+        return None
+
+    def find(self, query: dict = None, projection: dict = None) -> InMemoryCursor:
+        self._count("find")
+        return InMemoryCursor([project(doc, projection) for doc in self._find(query)], self._plan(query))
+
+    def aggregate(self, pipeline: list, **kwargs) -> InMemoryCursor:
+        """$match and $group with $push/$sum, the stages main4 uses."""
+        self._count("aggregate")
+        docs = [copy.deepcopy(doc) for doc in self._docs]
+        for stage in pipeline:
+            op, spec = next(iter(stage.items()))
+            if op == "$match":
+                docs = [doc for doc in docs if matches(doc, spec)]
+            elif op == "$group":
+                groups = {}
+                for doc in docs:
+                    key = evaluate(spec["_id"], doc)
+                    group = groups.setdefault(repr(key), {"_id": key})
+                    for field, accumulator in spec.items():
+                        if field == "_id":
+                            continue
+                        (acc, expression), = accumulator.items()
+                        value = evaluate(expression, doc)
+                        if acc == "$push":
+                            group.setdefault(field, []).append(value)
+                        elif acc == "$sum":
+                            group[field] = group.get(field, 0) + value
+                        else:
+                            raise NotImplementedError(f"Accumulator {acc} is not supported")
+                docs = list(groups.values())
+            else:
+                raise NotImplementedError(f"Aggregation stage {op} is not supported")
+        return InMemoryCursor(docs)
+
+    async def count_documents(self, query: dict, limit: int = 0, **kwargs) -> int:
+        self._count("count")
+        count = len(self._find(query))
+        return min(count, limit) if limit else count
+
+    async def insert_one(self, doc: dict) -> InsertOneResult:
+        self._count("insert")
+        doc.setdefault("_id", ObjectId())
+        self._insert(copy.deepcopy(doc))
+        return InsertOneResult(doc["_id"])
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False) -> UpdateResult:
+        self._count("update")
+        docs = self._find(query)[:1]
+        if docs:
+            apply_update(docs[0], update)
+            return UpdateResult(1, 1)
+        if upsert:
+            return UpdateResult(0, 0, self._upsert(query, update)["_id"])
+        return UpdateResult(0, 0)
+
+    async def update_many(self, query: dict, update: dict, upsert: bool = False) -> UpdateResult:
+        self._count("update")
+        docs = self._find(query)
+        for doc in docs:
+            apply_update(doc, update)
+        if not docs and upsert:
+            return UpdateResult(0, 0, self._upsert(query, update)["_id"])
+        return UpdateResult(len(docs), len(docs))
+
+    async def find_one_and_update(self, query: dict, update: dict, projection: dict = None, upsert: bool = False,
+                                  return_document: bool = ReturnDocument.BEFORE, **kwargs):
+        self._count("findAndModify")
+        docs = self._find(query)[:1]
+        if docs:
+            before = project(docs[0], projection)
+            apply_update(docs[0], update)
+            return before if return_document == ReturnDocument.BEFORE else project(docs[0], projection)
+        if upsert:
+            doc = self._upsert(query, update)
+            return None if return_document == ReturnDocument.BEFORE else project(doc, projection)
+        return None
+
+    async def find_one_and_delete(self, query: dict, projection: dict = None, **kwargs):
+        self._count("findAndModify")
+        docs = self._find(query)[:1]
+        if not docs:
+            return None
+        self._docs = [doc for doc in self._docs if doc is not docs[0]]
+        return project(docs[0], projection)
+
+    async def delete_many(self, query: dict) -> DeleteResult:
+        self._count("delete")
+        removed = {id(doc) for doc in self._find(query)}
+        self._docs = [doc for doc in self._docs if id(doc) not in removed]
+        return DeleteResult(len(removed))
+
+    async def delete_one(self, query: dict) -> DeleteResult:
+        self._count("delete")
+        removed = {id(doc) for doc in self._find(query)[:1]}
+        self._docs = [doc for doc in self._docs if id(doc) not in removed]
+        return DeleteResult(len(removed))
+
+    async def create_index(self, keys, unique: bool = False, name: str = None, **kwargs) -> str:
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        keys = list(keys)
+        name = name or "_".join(f"{field}_{direction}" for field, direction in keys)
+        if unique:
+            seen = set()
+            for doc in self._docs:
+                key = tuple(get_field(doc, field) for field, _ in keys)
+                if key in seen:
+                    raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {name}")
+                seen.add(key)
+        self._indexes[name] = {"key": keys, "unique": unique}
+        if "expireAfterSeconds" in kwargs:
+            self._indexes[name]["expireAfterSeconds"] = kwargs["expireAfterSeconds"]
+        return name
+
+    async def index_information(self) -> dict:
+        return copy.deepcopy(self._indexes)
+
+# ---------------------------
+# Wiring
+# ---------------------------
+def install_fakes(app_module, model: FakeModel = None) -> dict:
+    """Point main4's clients at in-memory stand-ins and return them."""
+    users = InMemoryCollection("users")
+    chats = InMemoryCollection("chats")
+    chat_archive = InMemoryCollection("chat_archive")
+    rate_limits = InMemoryCollection("rate_limits")
+    app_module.users_collection = users
+    app_module.chats_collection = chats
+    app_module.archive_collection = chat_archive
+    app_module.rate_limit_collection = rate_limits
+    app_module.model = model or FakeModel()
+    return {
+        "users": users,
+        "chats": chats,
+        "chat_archive": chat_archive,
+        "rate_limits": rate_limits,
+        "model": app_module.model,
+    }
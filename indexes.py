@@ -0,0 +1,142 @@
+"""Index bootstrap for the app's MongoDB collections.
+
+ensure_indexes() runs at startup. It creates every index in INDEXES that is
+missing and then confirms that each one exists with the expected keys and
+options. check_hot_queries() explains each filter shape the request path
+sends and fails if any of them would scan the whole collection. It works
+against real MongoDB and against the in-memory stand-ins in fakes.py:
+
+    collections = {"users": users, "chats": chats, "chat_archive": chat_archive}
+    created, failures = await ensure_indexes(collections)
+    await check_hot_queries(collections)
+"""
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import ASCENDING
+
+INDEXES = {
+    "users": [
+        # Also what makes signup safe against two requests for the same email
+        {"keys": [("email", ASCENDING)], "name": "email_unique", "unique": True},
+    ],
+    "chats": [
+        # One session per user; also what keeps concurrent upserts from creating a second
+        {"keys": [("user_id", ASCENDING)], "name": "user_id_unique", "unique": True},
+    ],
+    "chat_archive": [
+        # A user's past sessions in order, and time-range exports
+        {"keys": [("user_id", ASCENDING), ("ended_at", ASCENDING)], "name": "user_id_ended_at"},
+        {"keys": [("ended_at", ASCENDING)], "name": "ended_at"},
+        # A session's transcript is archived once, however often the write is retried
+        {"keys": [("session_id", ASCENDING), ("ended_at", ASCENDING)], "name": "session_id_ended_at_unique", "unique": True},
+    ],
+    "rate_limits": [
+        # Buckets are deleted once they would have refilled
+        {"keys": [("expires_at", ASCENDING)], "name": "expires_at_ttl", "expire_after_seconds": 0},
+    ],
+}
+
+# One filter per distinct shape the request path sends; only the field names
+# and operators matter, the values are placeholders. Keep in step with main4.
+HOT_QUERIES = [
+    ("users", {"email": "someone@example.com"}),
+    ("chats", {"user_id": "000000000000000000000000"}),
+    ("chats", {"_id": ObjectId("000000000000000000000000")}),
+    ("chats", {"_id": ObjectId("000000000000000000000000"), "version": 0}),
+    ("chats", {"_id": ObjectId("000000000000000000000000"), "version": {"$exists": False}}),
+    ("chats", {"user_id": "000000000000000000000000", "_id": {"$nin": []}}),
+    ("chat_archive", {"user_id": "000000000000000000000000"}),
+    ("chat_archive", {"user_id": "000000000000000000000000", "ended_at": {"$lte": datetime(2000, 1, 1)}}),
+    ("chat_archive", {"user_id": "000000000000000000000000", "started_at": datetime(2000, 1, 1)}),
+    ("chat_archive", {"user_id": "000000000000000000000000", "$or": [
+        {"ended_at": {"$lt": datetime(2000, 1, 1)}},
+        {"ended_at": datetime(2000, 1, 1), "_id": {"$lt": ObjectId("000000000000000000000000")}},
+    ]}),
+    ("rate_limits", {"_id": "user:000000000000000000000000"}),
+]
+
+class IndexCheckError(Exception):
+    """An index is missing or conflicting, or a hot query would scan the collection."""
+
+def _same_keys(info: dict, keys: list) -> bool:
+    return [tuple(k) for k in info["key"]] == [tuple(k) for k in keys]
+
+async def ensure_collection_indexes(collection, collection_name: str, specs: list) -> list:
+    """Create the collection's missing indexes, verify all of them and return the names created."""
+    created = []
+    existing = await collection.index_information()
+    for spec in specs:
+        match = next((name for name, info in existing.items() if _same_keys(info, spec["keys"])), None)
+        if match is None:
+            options = {"name": spec["name"], "unique": spec.get("unique", False)}
+            if "expire_after_seconds" in spec:
+                options["expireAfterSeconds"] = spec["expire_after_seconds"]
+            await collection.create_index(spec["keys"], **options)
+            created.append(f"{collection_name}.{spec['name']}")
+
+    # Verify, including indexes that were already there under another name
+    existing = await collection.index_information()
+    for spec in specs:
+        match = next((info for info in existing.values() if _same_keys(info, spec["keys"])), None)
+        if match is None:
+            raise IndexCheckError(f"{collection_name}: index {spec['name']} was not created")
+        if bool(match.get("unique")) != spec.get("unique", False):
+            raise IndexCheckError(
+                f"{collection_name}: index on {spec['keys']} exists but unique={bool(match.get('unique'))}; "
+                f"drop it so it can be recreated with unique={spec.get('unique', False)}"
+            )
+        if match.get("expireAfterSeconds") != spec.get("expire_after_seconds"):
+            raise IndexCheckError(
+                f"{collection_name}: index on {spec['keys']} exists but expireAfterSeconds="
+                f"{match.get('expireAfterSeconds')}; expected {spec.get('expire_after_seconds')}"
+            )
+    return created
+
+async def ensure_indexes(collections: dict, indexes: dict = INDEXES) -> tuple:
+    """Ensure every collection's indexes; returns (names created, {collection: error}).
+
+    A failing collection doesn't stop the others from being set up.
+    """
+    created, failures = [], {}
+    for collection_name, specs in indexes.items():
+        try:
+            created.extend(await ensure_collection_indexes(collections[collection_name], collection_name, specs))
+        except Exception as e:
+            failures[collection_name] = str(e)
+    return created, failures
+
+def plan_stages(plan: dict) -> list:
+    """Every stage name in an explain() winning plan, outermost first."""
+    stages = []
+    while plan:
+        stages.append(plan.get("stage"))
+        if "inputStages" in plan:
+            for child in plan["inputStages"]:
+                stages.extend(plan_stages(child))
+            break
+        plan = plan.get("inputStage")
+    return stages
+
+async def unindexed_queries(collections: dict, queries: list = HOT_QUERIES) -> list:
+    """Return (collection, filter, stages) for each query that would scan the collection."""
+    failures = []
+    for collection_name, query in queries:
+        explained = await collections[collection_name].find(query).explain()
+        winning = explained.get("queryPlanner", {}).get("winningPlan", {})
+        # The slot-based engine (MongoDB 7+) nests the classic plan tree
+        stages = plan_stages(winning.get("queryPlan", winning))
+        # Sharded clusters nest the per-shard plans one level down
+        for shard in winning.get("shards", []):
+            shard_plan = shard.get("winningPlan", {})
+            stages.extend(plan_stages(shard_plan.get("queryPlan", shard_plan)))
+        # IXSCAN, IDHACK and their EXPRESS_ variants on newer servers
+        if "COLLSCAN" in stages or not any("IXSCAN" in stage or "IDHACK" in stage for stage in stages if stage):
+            failures.append((collection_name, query, stages))
+    return failures
+
+async def check_hot_queries(collections: dict, queries: list = HOT_QUERIES):
+    failures = await unindexed_queries(collections, queries)
+    if failures:
+        details = "; ".join(f"{name} {query} -> {stages}" for name, query, stages in failures)
+        raise IndexCheckError(f"Hot queries without an index: {details}")
@@ -0,0 +1,198 @@
+"""Deadlines, hedged retries and a circuit breaker for Gemini calls.
+
+LLMGuard.call() runs one completion under the deadline for its conversation
+state. If hedging is on, a second attempt starts when the first is slow or
+fails. The CircuitBreaker watches the outcomes. When too many recent calls
+fail or run slow, it opens and later calls fail immediately instead of
+waiting on a degraded provider. After a cool-down a single probe call is let
+through, and its outcome closes or re-opens the breaker.
+
+Every failure mode raises LLMUnavailable, and callers answer with
+fallback_response() so the conversation can still move on.
+"""
+import asyncio
+import collections
+import time
+
+import metrics
+
+class LLMUnavailable(Exception):
+    """The completion could not be produced; `reason` says why."""
+
+    def __init__(self, reason: str, cause: Exception = None):
+        super().__init__(f"{reason}: {cause}" if cause else reason)
+        self.reason = reason
+        self.cause = cause
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+
+    def __init__(self, window: int = 20, min_calls: int = 10, failure_rate: float = 0.5,
+                 slow_call_seconds: float = 10.0, slow_call_rate: float = 0.5,
+                 open_seconds: float = 30.0, clock=time.monotonic):
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.clock = clock
+        self.state = self.CLOSED
+        # (failed, slow) for the most recent calls
+        self._outcomes = collections.deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    def allow(self) -> bool:
+        """Whether a call may go out now. In half-open, only one probe at a time."""
+        if self.state == self.OPEN:
+            if self.clock() - self._opened_at < self.open_seconds:
+                return False
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+        return True
+
+    def record(self, ok: bool, seconds: float):
+        slow = seconds >= self.slow_call_seconds
+        if self.state == self.HALF_OPEN:
+            self._probe_in_flight = False
+            if ok and not slow:
+                self.state = self.CLOSED
+                self._outcomes.clear()
+            else:
+                self._open()
+            return
+        self._outcomes.append((not ok, slow))
+        if self.state == self.CLOSED and len(self._outcomes) >= self.min_calls:
+            calls = len(self._outcomes)
+            failed = sum(1 for f, _ in self._outcomes if f)
+            slow_calls = sum(1 for _, s in self._outcomes if s)
+            if failed / calls >= self.failure_rate or slow_calls / calls >= self.slow_call_rate:
+                self._open()
+
+    def release(self):
+        """A call was abandoned (e.g. the client went away) without an outcome."""
+        if self.state == self.HALF_OPEN:
+            self._probe_in_flight = False
+
+    def _open(self):
+        self.state = self.OPEN
+        self._opened_at = self.clock()
+        self._outcomes.clear()
+        breaker_trips.inc()
+
+# ---------------------------
+# Metrics
+# ---------------------------
+BREAKER_STATE_VALUES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+
+breaker_trips = metrics.registry.counter("chatbot_llm_breaker_trips_total", "Times the Gemini circuit breaker opened.")
+llm_fallbacks = metrics.registry.counter(
+    "chatbot_llm_fallbacks_total", "Replies served from a template instead of Gemini.", ("state", "reason")
+)
+llm_hedges = metrics.registry.counter(
+    "chatbot_llm_hedges_total", "Second attempts started, by trigger.", ("state", "trigger")
+)
+
+class LLMGuard:
+    def __init__(self, breaker: CircuitBreaker, deadlines: dict, default_deadline: float, hedge_after: float = None):
+        self.breaker = breaker
+        self.deadlines = deadlines
+        self.default_deadline = default_deadline
+        self.hedge_after = hedge_after
+        metrics.registry.gauge(
+            "chatbot_llm_breaker_state", "Gemini circuit breaker: 0 closed, 1 half-open, 2 open.",
+            lambda: BREAKER_STATE_VALUES[self.breaker.state],
+        )
+
+    def deadline_for(self, state: str) -> float:
+        return self.deadlines.get(state, self.default_deadline)
+
+    async def call(self, state: str, attempt, deadline: float = None, hedge: bool = True,
+                   first_chunk_at=None) -> str:
+        """Run `attempt()` (a coroutine factory) within the state's deadline.
+
+        For streamed calls, `first_chunk_at()` returns the perf_counter() time
+        the first chunk arrived (or None), and the breaker judges slowness by
+        that rather than by how long the whole reply took to stream.
+
+        Raises LLMUnavailable with reason "circuit_open", "deadline" or "error".
+        """
+        if not self.breaker.allow():
+            raise LLMUnavailable("circuit_open")
+        deadline = self.deadline_for(state) if deadline is None else deadline
+        hedge_after = self.hedge_after if hedge and self.breaker.state != CircuitBreaker.HALF_OPEN else None
+        started = time.perf_counter()
+
+        def elapsed():
+            answered = first_chunk_at() if first_chunk_at is not None else None
+            return (answered or time.perf_counter()) - started
+
+        try:
+            if hedge_after is None:
+                result = await asyncio.wait_for(attempt(), timeout=deadline)
+            else:
+                result = await asyncio.wait_for(self._hedged(state, attempt, hedge_after), timeout=deadline)
+        except asyncio.CancelledError:
+            self.breaker.release()
+            raise
+        except asyncio.TimeoutError as e:
+            self.breaker.record(False, elapsed())
+            raise LLMUnavailable("deadline", e)
+        except Exception as e:
+            self.breaker.record(False, elapsed())
+            raise LLMUnavailable("error", e)
+        self.breaker.record(True, elapsed())
+        return result
+
+    async def _hedged(self, state: str, attempt, hedge_after: float) -> str:
+        """Start a second attempt if the first is still running after
+        `hedge_after` seconds, or straight away if it fails; first success wins."""
+        pending = {asyncio.create_task(attempt())}
+        hedged = False
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=None if hedged else hedge_after, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                if not hedged:
+                    hedged = True
+                    llm_hedges.inc(state, "error" if done else "slow")
+                    pending.add(asyncio.create_task(attempt()))
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+# ---------------------------
+# Fallback replies
+# ---------------------------
+# Used when Gemini is unavailable. Follow-ups rotate so repeated fallbacks
+# don't read the same, and keep to the follow-up prompt's no-questions rule.
+FALLBACK_RESPONSES = {
+    "empathetic_validation": [
+        "Thank you for trusting me with this. What you're going through sounds really hard, and it makes complete sense that it's weighing on you.",
+    ],
+    "followup": [
+        "I'd like to understand this a little better. Take your time and tell me more about how it has been affecting you day to day.",
+        "That sounds like a lot to carry. I'm here and listening, so share whatever feels important about it.",
+        "It can help to put these feelings into words. Tell me a bit more about what goes through your mind when it happens.",
+    ],
+    "final": [
+        "Thank you for sharing your thoughts with me. Here's a summary of our conversation and some practical suggestions that might help you move forward.",
+    ],
+}
+
+def fallback_response(state: str, turn: int = 0) -> str:
+    responses = FALLBACK_RESPONSES.get(state) or FALLBACK_RESPONSES["followup"]
+    return responses[turn % len(responses)]
@@ -0,0 +1,372 @@
+"""Offline load test for the chat state machine.
+
+Runs N simulated users against main4.app in-process, with Gemini and MongoDB
+replaced by the stand-ins in fakes.py. Every user signs up, logs in, calls
+/reset-on-login and then walks full conversations
+(greeting -> issue -> empathetic_validation -> followup x3 -> final, plus
+the turn the final state answers).
+
+Requests/s and latency percentiles are reported per endpoint and per chat
+state. Results are written to loadtest_results/ and compared with the
+previous run there, so a slowdown shows up as a regression:
+
+    python loadtest.py --users 200 --llm-median-ms 300
+    python loadtest.py --users 200 --llm-median-ms 300 --llm-failure-rate 0.05
+
+The exit status is 1 when any tracked percentile or the throughput regressed
+by more than --threshold percent.
+"""
+import os
+
+# Must be set before main4 and the spawned bcrypt workers read them
+os.environ.setdefault("SECRET_KEY", "loadtest-secret-key-not-for-production")
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+# Simulated users type far faster than people do; set these to load-test the limits
+os.environ.setdefault("CHAT_USER_RATE_PER_MINUTE", "0")
+os.environ.setdefault("CHAT_GLOBAL_RATE_PER_SECOND", "0")
+
+import argparse
+import asyncio
+import glob
+import json
+import random
+import subprocess
+import time
+from datetime import datetime, timezone
+
+import httpx
+from jose import jwt
+
+import indexes
+import llm_guard
+import main4
+from fakes import FakeModel, LatencyModel, install_fakes
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "loadtest_results")
+
+# Replies sent for each state the conversation can be in
+REPLIES = {
+    "greeting": ["I'm not doing great", "okay I guess", "pretty good actually", "terrible, honestly"],
+    "issue": [
+        "I've been really stressed about work and can't sleep",
+        "My partner and I keep arguing about small things",
+        "I feel lonely since I moved to a new city",
+    ],
+    "empathetic_validation": ["Yes, that's exactly it", "I suppose so", "It's more complicated than that"],
+    "followup": ["It started a few months ago", "Mostly in the evenings", "I haven't told anyone", "Maybe"],
+    "final": ["Thank you, that helps", "I'll try that"],
+}
+# A session that hasn't reached final after this many turns is abandoned
+MAX_TURNS_PER_SESSION = 30
+PASSWORD_RETRIES = 20
+PERCENTILES = (50, 95, 99)
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+
+    def add(self, group: str, name: str, seconds: float, ok: bool):
+        self.samples.setdefault((group, name), []).append(seconds)
+        if not ok:
+            self.errors[(group, name)] = self.errors.get((group, name), 0) + 1
+
+    def summary(self, group: str, duration: float) -> dict:
+        result = {}
+        for (sample_group, name), samples in sorted(self.samples.items()):
+            if sample_group != group:
+                continue
+            ordered = sorted(samples)
+            stats = {
+                "count": len(ordered),
+                "errors": self.errors.get((group, name), 0),
+                "rps": round(len(ordered) / duration, 2),
+                "mean_ms": round(1000 * sum(ordered) / len(ordered), 2),
+                "max_ms": round(1000 * ordered[-1], 2),
+            }
+            for pct in PERCENTILES:
+                stats[f"p{pct}_ms"] = round(1000 * percentile(ordered, pct), 2)
+            result[name] = stats
+        return result
+
+def percentile(ordered: list, pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+class SimulatedUser:
+    def __init__(self, index: int, client: httpx.AsyncClient, chats, recorder: Recorder, args, rnd: random.Random):
+        self.name = f"loadtest{index}"
+        self.email = f"loadtest{index}@example.com"
+        self.password = f"pw-{index}"
+        self.client = client
+        self.chats = chats
+        self.recorder = recorder
+        self.args = args
+        self.random = rnd
+        self.headers = None
+        self.uid = None
+
+    async def request(self, endpoint: str, state: str = None, **kwargs) -> httpx.Response:
+        method, path = endpoint.split(" ", 1)
+        started = time.perf_counter()
+        response = await self.client.request(method, path, **kwargs)
+        if path == "/chat/stream":
+            # Read the whole event stream so the timing covers the full reply
+            body = await response.aread()
+            ok = response.status_code == 200 and b"event: done" in body
+        else:
+            ok = response.status_code < 400
+        elapsed = time.perf_counter() - started
+        self.recorder.add("endpoints", endpoint, elapsed, ok)
+        if state is not None:
+            self.recorder.add("states", state, elapsed, ok)
+        return response
+
+    async def password_request(self, endpoint: str, **kwargs) -> httpx.Response:
+        # The bcrypt pool sheds load with 503 + Retry-After; back off like a client would
+        for _ in range(PASSWORD_RETRIES):
+            response = await self.request(endpoint, **kwargs)
+            if response.status_code != 503:
+                return response
+            await asyncio.sleep(float(response.headers.get("Retry-After", "1")) * self.random.uniform(0.5, 1.0))
+        return response
+
+    def current_state(self) -> str:
+        doc = self.chats.peek({"user_id": self.uid}, {"state": 1})
+        return doc["state"] if doc else "greeting"
+
+    async def think(self):
+        if self.args.think_ms:
+            await asyncio.sleep(self.random.expovariate(1000 / self.args.think_ms))
+
+    async def run(self):
+        response = await self.password_request(
+            "POST /signup", json={"name": self.name, "email": self.email, "password": self.password}
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"{self.email}: signup failed with {response.status_code}")
+        response = await self.password_request(
+            "POST /login", data={"username": self.email, "password": self.password}
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"{self.email}: login failed with {response.status_code}")
+        token = response.json()["access_token"]
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.uid = jwt.get_unverified_claims(token)["uid"]
+
+        completed = 0
+        for _ in range(self.args.sessions):
+            await self.request("POST /reset-on-login", headers=self.headers)
+            completed += await self.conversation()
+        return completed
+
+    async def conversation(self) -> int:
+        # First turn opens the session with an empty message
+        message = None
+        for _ in range(MAX_TURNS_PER_SESSION):
+            state = self.current_state()
+            endpoint = "POST /chat/stream" if self.random.random() < self.args.stream_fraction else "POST /chat"
+            body = {} if message is None else {"message": message}
+            response = await self.request(endpoint, state=state, json=body, headers=self.headers)
+            await self.think()
+            if response.status_code == 200 and state == "final":
+                return 1
+            message = self.random.choice(REPLIES.get(self.current_state(), REPLIES["followup"]))
+        return 0
+
+async def run_load(args) -> dict:
+    rnd = random.Random(args.seed)
+    model = FakeModel(
+        latency=LatencyModel(args.llm_median_ms, args.llm_distribution, args.llm_sigma, args.llm_spread_ms, seed=args.seed),
+        failure_rate=args.llm_failure_rate,
+        seed=args.seed,
+    )
+    fakes = install_fakes(main4, model)
+    # Same bootstrap as startup; fails the run if a hot query lost its index
+    collections = {name: fakes[name] for name in ("users", "chats", "chat_archive", "rate_limits")}
+    _, failures = await indexes.ensure_indexes(collections)
+    if failures:
+        raise indexes.IndexCheckError("; ".join(failures.values()))
+    main4.email_index_verified = True
+    await indexes.check_hot_queries(collections)
+    recorder = Recorder()
+
+    transport = httpx.ASGITransport(app=main4.app, raise_app_exceptions=False)
+    async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=None) as client:
+        users = [
+            SimulatedUser(i, client, fakes["chats"], recorder, args, random.Random(rnd.random()))
+            for i in range(args.users)
+        ]
+
+        async def start(user: SimulatedUser, delay: float):
+            await asyncio.sleep(delay)
+            return await user.run()
+
+        ramp = args.ramp_seconds / max(1, args.users)
+        started = time.perf_counter()
+        results = await asyncio.gather(*[start(u, i * ramp) for i, u in enumerate(users)], return_exceptions=True)
+        duration = time.perf_counter() - started
+
+    failed_users = [str(r) for r in results if isinstance(r, Exception)]
+    total = sum(len(s) for (group, _), s in recorder.samples.items() if group == "endpoints")
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "config": config_of(args),
+        "duration_seconds": round(duration, 3),
+        "requests": total,
+        "rps": round(total / duration, 2),
+        "completed_conversations": sum(r for r in results if isinstance(r, int)),
+        "failed_users": len(failed_users),
+        "failures": failed_users[:10],
+        "endpoints": recorder.summary("endpoints", duration),
+        "states": recorder.summary("states", duration),
+        "llm": {
+            "calls": model.calls,
+            "failures": model.failures,
+            "prompt_chars": model.prompt_chars,
+            "fallbacks": llm_guard.llm_fallbacks.total(),
+            "hedges": llm_guard.llm_hedges.total(),
+            "breaker_trips": llm_guard.breaker_trips.total(),
+        },
+        "mongo_operations": {name: c.operation_counts for name, c in fakes.items() if name != "model"},
+        "password_pool": main4.get_password_pool_metrics(),
+    }
+
+def config_of(args) -> dict:
+    return {
+        key: getattr(args, key) for key in (
+            "users", "sessions", "stream_fraction", "think_ms", "ramp_seconds", "seed",
+            "llm_median_ms", "llm_distribution", "llm_sigma", "llm_spread_ms", "llm_failure_rate",
+        )
+    }
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_table(title: str, rows: dict):
+    print(f"\n{title}")
+    print(f"  {'':<24} {'count':>7} {'err':>5} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, s in rows.items():
+        print(
+            f"  {name:<24} {s['count']:>7} {s['errors']:>5} {s['rps']:>8.1f} "
+            f"{s['p50_ms']:>9.1f} {s['p95_ms']:>9.1f} {s['p99_ms']:>9.1f} {s['max_ms']:>9.1f}"
+        )
+
+def print_report(result: dict):
+    print(
+        f"{result['requests']} requests in {result['duration_seconds']:.1f}s "
+        f"({result['rps']:.1f} req/s), {result['completed_conversations']} conversations completed, "
+        f"{result['failed_users']} users failed"
+    )
+    for failure in result["failures"]:
+        print(f"  {failure}")
+    print_table("Per endpoint", result["endpoints"])
+    print_table("Per state (/chat and /chat/stream)", result["states"])
+    llm = result["llm"]
+    print(
+        f"\nLLM calls {llm['calls']}, injected failures {llm['failures']}, fallbacks {llm['fallbacks']}, "
+        f"hedges {llm['hedges']}, breaker trips {llm['breaker_trips']}"
+    )
+    for name, counts in result["mongo_operations"].items():
+        print(f"Mongo {name}: " + ", ".join(f"{op} {n}" for op, n in sorted(counts.items())))
+
+def load_previous(results_dir: str) -> tuple:
+    paths = sorted(glob.glob(os.path.join(results_dir, "*.json")))
+    if not paths:
+        return None, None
+    with open(paths[-1], encoding="utf-8") as f:
+        return paths[-1], json.load(f)
+
+def compare(previous: dict, current: dict, threshold: float, min_delta_ms: float) -> list:
+    """Return a description of every metric that got worse by more than threshold percent.
+
+    Latency changes smaller than min_delta_ms are ignored, so jitter on
+    sub-millisecond endpoints doesn't count as a regression.
+    """
+    regressions = []
+
+    def check(label: str, before: float, after: float, higher_is_worse: bool = True):
+        if not before or (higher_is_worse and after - before < min_delta_ms):
+            return
+        change = 100 * (after - before) / before
+        if (change if higher_is_worse else -change) > threshold:
+            regressions.append(f"{label}: {before:.1f} -> {after:.1f} ({change:+.1f}%)")
+
+    check("throughput req/s", previous["rps"], current["rps"], higher_is_worse=False)
+    for group in ("endpoints", "states"):
+        for name, stats in current[group].items():
+            before = previous[group].get(name)
+            if not before:
+                continue
+            for pct in PERCENTILES[1:]:
+                check(f"{name} p{pct} ms", before[f"p{pct}_ms"], stats[f"p{pct}_ms"])
+    return regressions
+
+def save(result: dict, results_dir: str) -> str:
+    os.makedirs(results_dir, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    path = os.path.join(results_dir, f"{stamp}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    return path
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50, help="concurrent simulated users")
+    parser.add_argument("--sessions", type=int, default=1, help="full conversations per user")
+    parser.add_argument("--stream-fraction", type=float, default=0.0, help="share of turns sent to /chat/stream")
+    parser.add_argument("--think-ms", type=float, default=0, help="mean pause between a user's turns")
+    parser.add_argument("--ramp-seconds", type=float, default=0, help="spread user start times over this long")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--llm-median-ms", type=float, default=800)
+    parser.add_argument("--llm-distribution", choices=["fixed", "uniform", "lognormal"], default="lognormal")
+    parser.add_argument("--llm-sigma", type=float, default=0.5, help="lognormal shape")
+    parser.add_argument("--llm-spread-ms", type=float, default=0, help="uniform half-width")
+    parser.add_argument("--llm-failure-rate", type=float, default=0.0)
+    parser.add_argument("--results-dir", default=RESULTS_DIR)
+    parser.add_argument("--baseline", help="result file to compare with instead of the latest one")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed regression in percent")
+    parser.add_argument("--min-delta-ms", type=float, default=5.0, help="ignore latency changes below this")
+    parser.add_argument("--no-save", action="store_true", help="don't store this run's results")
+    args = parser.parse_args()
+
+    try:
+        result = asyncio.run(run_load(args))
+    finally:
+        if main4.password_pool is not None:
+            main4.password_pool.shutdown(cancel_futures=True)
+    print_report(result)
+
+    if args.baseline:
+        baseline_path = args.baseline
+        with open(baseline_path, encoding="utf-8") as f:
+            baseline = json.load(f)
+    else:
+        baseline_path, baseline = load_previous(args.results_dir)
+
+    regressions = []
+    if baseline is None:
+        print("\nNo previous results to compare with")
+    elif baseline["config"] != result["config"]:
+        print(f"\nNot comparing with {baseline_path}: it was run with a different configuration")
+    else:
+        regressions = compare(baseline, result, args.threshold, args.min_delta_ms)
+        print(f"\nCompared with {baseline_path} (commit {baseline.get('git_commit')}):")
+        for line in regressions or ["no regressions"]:
+            print(f"  {line}")
+
+    if not args.no_save:
+        print(f"Results written to {save(result, args.results_dir)}")
+    if regressions:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,40 @@
 import os
+import json
+import base64
+import hashlib
+import time
 import asyncio
-from fastapi import FastAPI, Depends, HTTPException, status
+import hmac
+import math
+import multiprocessing
+from contextlib import asynccontextmanager
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextvars import ContextVar
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Response, status
 from pydantic import BaseModel, EmailStr
-from pymongo import MongoClient
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from bson import ObjectId
-from passlib.context import CryptContext
 from datetime import datetime, timedelta, timezone
 from jose import JWTError, jwt
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from starlette.concurrency import run_in_threadpool
 
-import nltk
-from nltk.sentiment import SentimentIntensityAnalyzer
 from motor.motor_asyncio import AsyncIOMotorClient
-import google.generativeai as genai
 
 from dotenv import load_dotenv
 load_dotenv()
 
-# Download VADER lexicon
-nltk.download("vader_lexicon")
+import archive
+import indexes
+import llm_guard
+import metrics
+import password_worker
+import ratelimit
 
 # ---------------------------
 # Configuration & Initialization
@@ -28,26 +43,275 @@ SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "120"))
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/login")
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", "300"))
 
-# --- Synchronous MongoDB for Users ---
-database_url = os.getenv("DATABASE_URL")
-client_sync = MongoClient(database_url)
-db_sync = client_sync["chatbot_db"]
-users_collection = db_sync["users"]
+# Database clients, the Gemini model and the sentiment analyzer are created
+# from the lifespan hook rather than at import, so starting a worker does no
+# network I/O until the app is actually serving.
 
-# --- Asynchronous MongoDB for Chats ---
-MONGO_URL = os.getenv("MONGO_URL")
-client_async = AsyncIOMotorClient(MONGO_URL)
-db_async = client_async["chatbot_db"]
-chats_collection = db_async["chats"]
+# --- MongoDB ---
+# One async client per worker serves both users and chats, so each worker
+# holds a single connection pool against the cluster's connection limit.
+# Users used to live on DATABASE_URL and chats on MONGO_URL. Deployments where
+# the two differ must first copy chatbot_db.users to the MONGO_URL cluster
+# (e.g. mongodump/mongorestore) and then unset DATABASE_URL or point it at
+# the same URL; until then startup fails rather than lose the users.
+MONGO_URL = os.getenv("MONGO_URL") or os.getenv("DATABASE_URL")
+LEGACY_USERS_URL = os.getenv("DATABASE_URL")
+# Connections per worker; workers x MONGO_MAX_POOL_SIZE must stay under the
+# database tier's limit
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "20"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "60000"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "15000"))
+# How long a request waits for a free pooled connection before failing
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "2000"))
+# Left to the server/URI defaults unless set, e.g. "majority" / "local" / "primaryPreferred"
+MONGO_WRITE_CONCERN = os.getenv("MONGO_WRITE_CONCERN")
+MONGO_READ_CONCERN = os.getenv("MONGO_READ_CONCERN")
+MONGO_READ_PREFERENCE = os.getenv("MONGO_READ_PREFERENCE")
+mongo_client = None
+users_collection = None
+chats_collection = None
+archive_collection = None
+rate_limit_collection = None
+
+# Sessions are loaded with only the most recent messages; the full transcript
+# stays in Mongo and is appended to, never rewritten
+HISTORY_CONTEXT_MESSAGES = int(os.getenv("HISTORY_CONTEXT_MESSAGES", "40"))
+
+# --- Session Archive ---
+# Finished and reset sessions move to chat_archive as compressed transcripts
+ARCHIVE_COMPRESSION_LEVEL = int(os.getenv("ARCHIVE_COMPRESSION_LEVEL", "6"))
+ARCHIVE_WRITE_ATTEMPTS = int(os.getenv("ARCHIVE_WRITE_ATTEMPTS", "3"))
+# How long shutdown waits for archive writes still in flight
+ARCHIVE_DRAIN_SECONDS = float(os.getenv("ARCHIVE_DRAIN_SECONDS", "10"))
+# Bulk export is disabled unless a token is configured
+ARCHIVE_EXPORT_TOKEN = os.getenv("ARCHIVE_EXPORT_TOKEN")
 
 # --- Gemini Configuration ---
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-model = genai.GenerativeModel('gemini-2.0-flash')
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-2.0-flash")
+model = None
+
+# --- Sentiment Analyzer ---
+# "packaged" reads the VADER lexicon bundled in data/; "nltk" downloads NLTK's
+# copy at startup as before
+SENTIMENT_LEXICON = os.getenv("SENTIMENT_LEXICON", "packaged")
+sia = None
+
+def mongo_client_options() -> dict:
+    options = {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": MONGO_MAX_IDLE_TIME_MS,
+        "connectTimeoutMS": MONGO_CONNECT_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "socketTimeoutMS": MONGO_SOCKET_TIMEOUT_MS,
+        "waitQueueTimeoutMS": MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        "event_listeners": [metrics.mongo_listener, metrics.mongo_pool_listener],
+    }
+    if MONGO_WRITE_CONCERN:
+        options["w"] = int(MONGO_WRITE_CONCERN) if MONGO_WRITE_CONCERN.isdigit() else MONGO_WRITE_CONCERN
+    if MONGO_READ_CONCERN:
+        options["readConcernLevel"] = MONGO_READ_CONCERN
+    if MONGO_READ_PREFERENCE:
+        options["readPreference"] = MONGO_READ_PREFERENCE
+    return options
+
+def check_mongo_urls():
+    if LEGACY_USERS_URL and LEGACY_USERS_URL != MONGO_URL:
+        raise RuntimeError(
+            "DATABASE_URL and MONGO_URL point at different servers, but users and chats are now both "
+            "served from MONGO_URL. Move chatbot_db.users to the MONGO_URL cluster, then unset "
+            "DATABASE_URL or set it to MONGO_URL."
+        )
+
+def init_clients():
+    """Create whichever database clients and LLM model don't exist yet."""
+    global mongo_client, users_collection, chats_collection, archive_collection, rate_limit_collection, model
+    if users_collection is None or chats_collection is None:
+        check_mongo_urls()
+        mongo_client = AsyncIOMotorClient(MONGO_URL, **mongo_client_options())
+        db = mongo_client["chatbot_db"]
+        users_collection = db["users"]
+        chats_collection = db["chats"]
+        archive_collection = db["chat_archive"]
+        rate_limit_collection = db["rate_limits"]
+        if RATE_LIMIT_BACKEND == "mongo":
+            chat_admission.backend = ratelimit.MongoBackend(rate_limit_collection)
+    if model is None:
+        # Imported here because the SDK alone takes about a second to import
+        import google.generativeai as genai
+        genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+        model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+
+def get_sentiment_analyzer():
+    global sia
+    if sia is None:
+        from sentiment import SentimentEngine
+        if SENTIMENT_LEXICON == "nltk":
+            import nltk
+            from nltk.sentiment import SentimentIntensityAnalyzer
+            nltk.download("vader_lexicon")
+            sia = SentimentEngine(SentimentIntensityAnalyzer().lexicon)
+        else:
+            sia = SentimentEngine()
+    return sia
+
+def detect_mood(text: str) -> str:
+    """Label a reply as positive, neutral or negative."""
+    with metrics.span("sentiment"):
+        return get_sentiment_analyzer().mood(text)
+
+# --- LLM Execution Limits ---
+# Gemini calls go through the model's native async client, which shares one
+# gRPC channel per worker. The semaphore caps in-flight requests so a burst of
+# conversations can't open an unbounded number of streams against the API.
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "64"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "25"))
+LLM_STREAM_TIMEOUT_SECONDS = float(os.getenv("LLM_STREAM_TIMEOUT_SECONDS", "60"))
+llm_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+llm_stats = {"in_flight": 0}
+
+# Each LLM-backed state has its own deadline, well inside the frontend's
+# 30-45 s request timeouts. Past it, or while the circuit breaker is open,
+# the turn is answered from a template so the conversation still advances.
+LLM_DEADLINES = {
+    "empathetic_validation": float(os.getenv("LLM_DEADLINE_VALIDATION_SECONDS", "10")),
+    "followup": float(os.getenv("LLM_DEADLINE_FOLLOWUP_SECONDS", "10")),
+    "final": float(os.getenv("LLM_DEADLINE_FINAL_SECONDS", "20")),
+}
+# Start a second attempt when the first hasn't answered after this long
+# (or has failed); 0 disables hedging
+LLM_HEDGE_AFTER_SECONDS = float(os.getenv("LLM_HEDGE_AFTER_SECONDS", "0")) or None
+gemini_guard = llm_guard.LLMGuard(
+    llm_guard.CircuitBreaker(
+        window=int(os.getenv("LLM_BREAKER_WINDOW", "20")),
+        min_calls=int(os.getenv("LLM_BREAKER_MIN_CALLS", "10")),
+        failure_rate=float(os.getenv("LLM_BREAKER_FAILURE_RATE", "0.5")),
+        slow_call_seconds=float(os.getenv("LLM_BREAKER_SLOW_SECONDS", "8")),
+        slow_call_rate=float(os.getenv("LLM_BREAKER_SLOW_RATE", "0.5")),
+        open_seconds=float(os.getenv("LLM_BREAKER_OPEN_SECONDS", "30")),
+    ),
+    deadlines=LLM_DEADLINES,
+    default_deadline=LLM_TIMEOUT_SECONDS,
+    hedge_after=LLM_HEDGE_AFTER_SECONDS,
+)
+
+# --- Admission Control ---
+# Chat turns draw on a per-user and a global token bucket before they start,
+# so one client can't spend the Gemini quota for everyone. "memory" enforces
+# the limits per worker; "mongo" shares the buckets between workers.
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+# 0 turns a bucket off
+CHAT_USER_RATE_PER_MINUTE = float(os.getenv("CHAT_USER_RATE_PER_MINUTE", "20"))
+CHAT_USER_BURST = float(os.getenv("CHAT_USER_BURST", "10"))
+CHAT_GLOBAL_RATE_PER_SECOND = float(os.getenv("CHAT_GLOBAL_RATE_PER_SECOND", "50"))
+CHAT_GLOBAL_BURST = float(os.getenv("CHAT_GLOBAL_BURST", "100"))
+# Turns in these states call Gemini and get a 429 when every slot is taken
+LLM_TURN_STATES = {"issue", "empathetic_validation", "followup"}
+LLM_BUSY_RETRY_AFTER_SECONDS = int(os.getenv("LLM_BUSY_RETRY_AFTER_SECONDS", "2"))
+chat_admission = ratelimit.AdmissionController(
+    ratelimit.MemoryBackend(RATE_LIMIT_MAX_KEYS),
+    user_rate=CHAT_USER_RATE_PER_MINUTE / 60,
+    user_burst=CHAT_USER_BURST,
+    global_rate=CHAT_GLOBAL_RATE_PER_SECOND,
+    global_burst=CHAT_GLOBAL_BURST,
+)
+
+# Set by /chat/stream so generate_text forwards Gemini chunks as they arrive
+stream_sink: ContextVar = ContextVar("stream_sink", default=None)
+# Sent through the sink when a turn is retried, so already streamed text is discarded
+STREAM_RESET = object()
+
+# --- Startup & Readiness ---
+MONGO_PING_RETRY_SECONDS = float(os.getenv("MONGO_PING_RETRY_SECONDS", "2"))
+readiness = {"ready": False, "warmup_seconds": None, "components": {}}
+# Until the unique email index is known to exist, signup checks for duplicates itself
+email_index_verified = False
+
+async def warm_up():
+    """Load everything the first chat turn would otherwise wait for."""
+    global email_index_verified
+    started = time.perf_counter()
+    components = readiness["components"]
+
+    await run_in_threadpool(get_sentiment_analyzer)
+    components["sentiment"] = "ok"
+
+    # Start the bcrypt workers now instead of on the first login
+    loop = asyncio.get_running_loop()
+    pool = get_password_pool()
+    await asyncio.gather(*[loop.run_in_executor(pool, password_worker.ping) for _ in range(PASSWORD_POOL_WORKERS)])
+    components["password_pool"] = "ok"
+
+    if mongo_client is not None:
+        while True:
+            try:
+                await mongo_client.admin.command("ping")
+                break
+            except Exception as e:
+                components["mongo"] = f"error: {e}"
+                await asyncio.sleep(MONGO_PING_RETRY_SECONDS)
+    components["mongo"] = "ok"
+
+    result = await backfill_session_counters()
+    if result.modified_count:
+        print(f"Backfilled message counts on {result.modified_count} chat sessions")
+
+    # A collection whose index build fails (e.g. duplicate emails already
+    # stored) is reported but doesn't hold back the others or the worker;
+    # signup then falls back to checking for the email itself
+    collections = {
+        "users": users_collection,
+        "chats": chats_collection,
+        "chat_archive": archive_collection,
+        "rate_limits": rate_limit_collection,
+    }
+    created, failures = await indexes.ensure_indexes(collections)
+    if "chats" in failures:
+        # Sessions duplicated by concurrent requests from before the unique index
+        merged = await merge_duplicate_sessions()
+        if merged:
+            print(f"Removed duplicate chat sessions of users: {', '.join(str(user_id) for user_id in merged)}")
+            del failures["chats"]
+            retried, retry_failures = await indexes.ensure_indexes(collections, {"chats": indexes.INDEXES["chats"]})
+            created += retried
+            failures.update(retry_failures)
+    if created:
+        print(f"Created indexes: {', '.join(created)}")
+    email_index_verified = "users" not in failures
+    try:
+        await indexes.check_hot_queries(collections)
+    except Exception as e:
+        failures["hot_queries"] = str(e)
+    for name, error in failures.items():
+        print(f"Index check failed for {name}: {error}")
+    components["indexes"] = "ok" if not failures else "error: " + "; ".join(failures.values())
+
+    pending = await resume_pending_archives()
+    if pending:
+        print(f"Resumed {pending} pending session archive writes")
+
+    readiness["warmup_seconds"] = round(time.perf_counter() - started, 3)
+    readiness["ready"] = True
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    init_clients()
+    warmup_task = asyncio.create_task(warm_up())
+    yield
+    warmup_task.cancel()
+    await drain_archive_tasks(ARCHIVE_DRAIN_SECONDS)
+    if password_pool is not None:
+        password_pool.shutdown(wait=False, cancel_futures=True)
 
-# --- Initialize FastAPI app and Sentiment Analyzer ---
-app = FastAPI()
-sia = SentimentIntensityAnalyzer()
+# --- Initialize FastAPI app ---
+app = FastAPI(lifespan=lifespan)
 
 # Add this after creating your FastAPI app instance (app = FastAPI())
 app.add_middleware(
@@ -59,16 +323,84 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*", "Authorization"],  # Explicitly allow Authorization header
+    expose_headers=["Server-Timing", "ETag"],
 )
 
+# Stage timings for every request; the Server-Timing header can be turned off
+# where clients shouldn't see them
+SERVER_TIMING_HEADER = os.getenv("SERVER_TIMING_HEADER", "1") == "1"
+app.add_middleware(metrics.ServerTimingMiddleware, header=SERVER_TIMING_HEADER)
+
 # --- Password Hashing ---
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt runs on its own process pool so a login burst can't starve the
+# threadpool or event loop that serve chat traffic. Once every worker is busy
+# and the queue is full, new credential checks are turned away immediately.
+PASSWORD_POOL_WORKERS = int(os.getenv("PASSWORD_POOL_WORKERS", "2"))
+PASSWORD_POOL_MAX_QUEUE = int(os.getenv("PASSWORD_POOL_MAX_QUEUE", "32"))
+PASSWORD_POOL_RETRY_AFTER_SECONDS = int(os.getenv("PASSWORD_POOL_RETRY_AFTER_SECONDS", "2"))
+
+password_pool = None
+password_pool_stats = {"in_flight": 0, "peak_in_flight": 0, "completed": 0, "rejected": 0}
+
+def get_password_pool() -> ProcessPoolExecutor:
+    global password_pool
+    if password_pool is None:
+        # spawn rather than fork: forking after the gRPC and Mongo clients
+        # have started threads is unsafe
+        password_pool = ProcessPoolExecutor(
+            max_workers=PASSWORD_POOL_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return password_pool
+
+async def run_password_job(func, *args):
+    global password_pool
+    if password_pool_stats["in_flight"] >= PASSWORD_POOL_WORKERS + PASSWORD_POOL_MAX_QUEUE:
+        password_pool_stats["rejected"] += 1
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many sign-in requests right now, please try again shortly",
+            headers={"Retry-After": str(PASSWORD_POOL_RETRY_AFTER_SECONDS)},
+        )
+    password_pool_stats["in_flight"] += 1
+    password_pool_stats["peak_in_flight"] = max(password_pool_stats["peak_in_flight"], password_pool_stats["in_flight"])
+    try:
+        pool = get_password_pool()
+        loop = asyncio.get_running_loop()
+        with metrics.span("password"):
+            return await loop.run_in_executor(pool, func, *args)
+    except BrokenProcessPool as e:
+        # A worker died (e.g. OOM-killed); the pool can't recover, so the next job builds a new one
+        print(f"Password pool broken, restarting it: {e}")
+        if password_pool is pool:
+            password_pool = None
+            pool.shutdown(wait=False, cancel_futures=True)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many sign-in requests right now, please try again shortly",
+            headers={"Retry-After": str(PASSWORD_POOL_RETRY_AFTER_SECONDS)},
+        )
+    finally:
+        password_pool_stats["in_flight"] -= 1
+        password_pool_stats["completed"] += 1
+
+def get_password_pool_metrics() -> dict:
+    in_flight = password_pool_stats["in_flight"]
+    return {
+        "workers": PASSWORD_POOL_WORKERS,
+        "max_queue": PASSWORD_POOL_MAX_QUEUE,
+        "in_flight": in_flight,
+        "queued": max(0, in_flight - PASSWORD_POOL_WORKERS),
+        "peak_in_flight": password_pool_stats["peak_in_flight"],
+        "completed": password_pool_stats["completed"],
+        "rejected": password_pool_stats["rejected"],
+    }
 
-def hash_password(password: str):
-    return pwd_context.hash(password)
+async def hash_password(password: str):
+    return await run_password_job(password_worker.hash_password, password)
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password, hashed_password):
+    return await run_password_job(password_worker.verify_password, plain_password, hashed_password)
 
 def create_access_token(data: dict, expires_delta: timedelta):
     to_encode = data.copy()
@@ -77,19 +409,85 @@ def create_access_token(data: dict, expires_delta: timedelta):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_current_user(token: str = Depends(oauth2_scheme)):
+# --- Auth Cache ---
+class TTLCache:
+    """Bounded LRU cache whose entries expire after a per-entry TTL."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def discard_values(self, predicate):
+        for key in [k for k, (value, _) in self._data.items() if predicate(value)]:
+            del self._data[key]
+
+    def __len__(self):
+        return len(self._data)
+
+# Verified tokens -> user dict, and email -> user dict for tokens issued
+# before the uid/name claims existed
+token_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL_SECONDS)
+user_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL_SECONDS)
+
+def invalidate_user_cache(email: str):
+    """Drop every cached token and record for a user so the next request re-verifies."""
+    user_cache.pop(email)
+    token_cache.discard_values(lambda user: user["email"] == email)
+
+async def get_current_user(token: str = Depends(oauth2_scheme)):
+    cached_user = token_cache.get(token)
+    if cached_user is not None:
+        return cached_user
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        with metrics.span("jwt"):
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
         if email is None:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
-        user = users_collection.find_one({"email": email})
-        if user is None:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
-        return {"id": str(user["_id"]), "name": user["name"], "email": user["email"]}
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
 
+    if payload.get("uid") and payload.get("name") is not None:
+        # Fast path: the token already carries the stable user claims
+        current_user = {"id": payload["uid"], "name": payload["name"], "email": email}
+    else:
+        current_user = user_cache.get(email)
+        if current_user is None:
+            with metrics.span("user_lookup"):
+                user = await users_collection.find_one({"email": email}, {"name": 1, "email": 1})
+            if user is None:
+                raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
+            current_user = {"id": str(user["_id"]), "name": user["name"], "email": user["email"]}
+            user_cache.set(email, current_user)
+
+    # Never cache a token past its own expiry
+    token_cache.set(token, current_user, ttl=payload.get("exp", 0) - time.time())
+    return current_user
+
 # ---------------------------
 # Pydantic Models
 # ---------------------------
@@ -110,19 +508,25 @@ class ChatMessage(BaseModel):
 # User Endpoints: Signup, Login, Protected
 # ---------------------------
 @app.post("/signup", response_model=UserResponseSignup)
-def signup(user: UserCreate):
-    existing_user = users_collection.find_one({"email": user.email})
-    if existing_user:
-        raise HTTPException(status_code=400, detail="Email already registered")
-    hashed = hash_password(user.password)
+async def signup(user: UserCreate):
+    if not email_index_verified:
+        with metrics.span("user_lookup"):
+            if await users_collection.find_one({"email": user.email}, {"_id": 1}):
+                raise HTTPException(status_code=400, detail="Email already registered")
+    hashed = await hash_password(user.password)
     user_data = {"name": user.name, "email": user.email, "password": hashed}
-    result = users_collection.insert_one(user_data)
+    # The unique index on email rejects duplicates, including concurrent signups
+    try:
+        result = await users_collection.insert_one(user_data)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
     return {"id": str(result.inserted_id), "name": user.name, "email": user.email}
 
 @app.post("/login")
-def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = users_collection.find_one({"email": form_data.username})
-    if not user or not verify_password(form_data.password, user["password"]):
+async def login(form_data: OAuth2PasswordRequestForm = Depends()):
+    with metrics.span("user_lookup"):
+        user = await users_collection.find_one({"email": form_data.username})
+    if not user or not await verify_password(form_data.password, user["password"]):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
     
     # Print user info for debugging
@@ -133,7 +537,10 @@ def login(form_data: OAuth2PasswordRequestForm = Depends()):
     # Make sure name field exists
     user_name = user.get("name", form_data.username.split('@')[0])  # Default to username if name not found
     
-    access_token = create_access_token({"sub": user["email"]}, timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+    access_token = create_access_token(
+        {"sub": user["email"], "uid": str(user["_id"]), "name": user_name},
+        timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES),
+    )
     return {
         "access_token": access_token, 
         "token_type": "bearer",
@@ -146,31 +553,26 @@ async def reset_on_login(current_user: dict = Depends(get_current_user)):
     user_id = current_user["id"]
     username = current_user["name"]
     
-    # Update any existing chat sessions to reset to greeting state
+    # Reset any existing chat sessions to greeting state, archiving their transcripts
     # Add a special flag force_greeting that will be checked in chat_handler
-    await chats_collection.update_many(
-        {"user_id": user_id},
-        {
-            "$set": {
-                "state": "greeting",
-                "history": [],
-                "mood": None,
-                "issue": None,
-                "followup_count": 0,
-                "force_greeting": True  # Special flag to ensure greeting is shown
-            }
-        }
-    )
+    session_ids = await archive_sessions(user_id, "reset-on-login", {
+        "state": "greeting",
+        "message_count": 0,
+        "history_start": 0,
+        "context_summary": [],
+        "summarized_through": 0,
+        "mood": None,
+        "issue": None,
+        "followup_count": 0,
+        "force_greeting": True  # Special flag to ensure greeting is shown
+    })
     
     # Check if this is a returning user (had previous sessions)
-    previous_sessions = await chats_collection.find(
-        {"user_id": user_id}
-    ).to_list(length=100)
-    
-    is_returning = len(previous_sessions) > 1  # More than just the session we just reset
+    session_count = len(session_ids)
+    is_returning = session_count > 1  # More than just the session we just reset
     
     # If no sessions exist at all, create one
-    if len(previous_sessions) == 0:
+    if session_count == 0:
         new_chat = {
             "user_id": user_id,
             "username": username,
@@ -179,15 +581,62 @@ async def reset_on_login(current_user: dict = Depends(get_current_user)):
             "issue": None,
             "followup_count": 0,
             "history": [],
+            "message_count": 0,
+            "history_start": 0,
             "is_returning": is_returning,
-            "is_new_user": len(previous_sessions) == 0,
+            "is_new_user": session_count == 0,
             "force_greeting": True,  # Force greeting for new users too
+            "version": 0,
             "created_at": datetime.now(timezone.utc)
         }
-        await chats_collection.insert_one(new_chat)
+        try:
+            await chats_collection.insert_one(new_chat)
+        except DuplicateKeyError:
+            # A concurrent request created the user's session first
+            pass
     
     return {"message": "Chat state reset to greeting", "is_returning": is_returning}
 
+@app.get("/metrics/password-pool")
+def password_pool_metrics():
+    return get_password_pool_metrics()
+
+# Values kept elsewhere in this module, read when /metrics is scraped
+metrics.registry.gauge(
+    "chatbot_password_pool_jobs", "bcrypt jobs running or queued on the password pool.",
+    lambda: {(key,): get_password_pool_metrics()[key] for key in ("in_flight", "queued", "peak_in_flight")}, ("kind",),
+)
+metrics.registry.gauge(
+    "chatbot_password_pool_jobs_total", "bcrypt jobs finished or turned away.",
+    lambda: {(key,): password_pool_stats[key] for key in ("completed", "rejected")}, ("outcome",), metric_type="counter",
+)
+metrics.registry.gauge("chatbot_password_pool_capacity", "Password pool workers plus queue slots.",
+                       lambda: PASSWORD_POOL_WORKERS + PASSWORD_POOL_MAX_QUEUE)
+metrics.registry.gauge("chatbot_llm_in_flight", "Gemini calls currently running.", lambda: llm_stats["in_flight"])
+metrics.registry.gauge("chatbot_llm_concurrency_limit", "Maximum concurrent Gemini calls per worker.", lambda: LLM_MAX_CONCURRENCY)
+metrics.registry.gauge("chatbot_auth_cache_entries", "Entries in the auth caches.",
+                       lambda: {("token",): len(token_cache), ("user",): len(user_cache)}, ("cache",))
+metrics.registry.gauge(
+    "chatbot_mongo_pool_connections", "Pooled MongoDB connections per server.",
+    lambda: {
+        (address, kind): count
+        for address, pool in metrics.mongo_pool_listener.snapshot().items()
+        for kind, count in pool.items()
+    },
+    ("address", "kind"),
+)
+metrics.registry.gauge("chatbot_mongo_pool_max_size", "Configured MongoDB pool size per server.", lambda: MONGO_MAX_POOL_SIZE)
+metrics.registry.gauge(
+    "chatbot_archive_writes_total", "Session archive writes by outcome.",
+    lambda: {(key,): value for key, value in archive_stats.items()}, ("outcome",), metric_type="counter",
+)
+metrics.registry.gauge("chatbot_archive_pending", "Session archive writes still in flight.", lambda: len(archive_tasks))
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    """Prometheus text exposition of this worker's metrics."""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/protected")
 def protected_route(user: dict = Depends(get_current_user)):
     return {"message": "You are authenticated", "user": user}
@@ -197,24 +646,37 @@ async def reset_chat(current_user: dict = Depends(get_current_user)):
     user_id = current_user["id"]
     username = current_user["name"]
     
-    # Delete all previous chat sessions for this user
-    await chats_collection.delete_many({"user_id": user_id})
-    
-    # Create a new chat session with empty history
-    new_chat = {
-        "user_id": user_id,
+    # Start the user over with an empty session; their transcripts are deleted, not archived
+    fresh_session = {
         "username": username,
         "state": "greeting",
         "mood": None,
         "issue": None,
         "followup_count": 0,
-        "history": [],
+        "message_count": 0,
+        "history_start": 0,
+        "context_summary": [],
+        "summarized_through": 0,
+        "completed_sessions": 0,
         "is_returning": False,  # Set to False as we're starting fresh
+        "is_new_user": False,
+        "force_greeting": False,
+        "pending_archives": [],  # Deleted along with the rest of the history
         "created_at": datetime.now(timezone.utc)
     }
+    session_ids = await archive_sessions(user_id, None, fresh_session)
+    await delete_archived_history(user_id)
     
-    # Insert the new session
-    await chats_collection.insert_one(new_chat)
+    if session_ids:
+        # Keep a single session per user
+        if len(session_ids) > 1:
+            await chats_collection.delete_many({"user_id": user_id, "_id": {"$ne": session_ids[0]}})
+    else:
+        # Insert the new session, unless a concurrent request just did
+        try:
+            await chats_collection.insert_one({**fresh_session, "user_id": user_id, "history": [], "version": 0})
+        except DuplicateKeyError:
+            pass
     
     # Return success message
     return {"message": "Chat history deleted and new session started"}
@@ -222,93 +684,703 @@ async def reset_chat(current_user: dict = Depends(get_current_user)):
 @app.post("/logout")
 async def logout(current_user: dict = Depends(get_current_user)):
     user_id = current_user["id"]
+    invalidate_user_cache(current_user["email"])
     
     # Clear the user's current chat state
-    # We'll update any existing chat session to reset its state to "greeting"
-    # and empty the history
-    await chats_collection.update_many(
-        {"user_id": user_id},
-        {
-            "$set": {
-                "state": "greeting",
-                "history": [],
-                "mood": None,
-                "issue": None,
-                "followup_count": 0
-            }
-        }
-    )
+    # We'll reset any existing chat session to "greeting"; the history moves
+    # to the archive
+    await archive_sessions(user_id, "logout", {
+        "state": "greeting",
+        "message_count": 0,
+        "history_start": 0,
+        "context_summary": [],
+        "summarized_through": 0,
+        "mood": None,
+        "issue": None,
+        "followup_count": 0
+    })
     
     return {"message": "Logged out successfully, chat state cleared"}
 
+# ---------------------------
+# Archive Export
+# ---------------------------
+ARCHIVE_EXPORT_BATCH_SIZE = int(os.getenv("ARCHIVE_EXPORT_BATCH_SIZE", "500"))
+
+@app.get("/archive/export")
+async def export_archive(
+    since: datetime = None,
+    until: datetime = None,
+    user_id: str = None,
+    include_transcript: bool = True,
+    x_archive_token: str = Header(None),
+):
+    """Stream archived sessions as NDJSON, oldest first, for analytics jobs."""
+    # The endpoint doesn't exist unless a token is configured
+    if not ARCHIVE_EXPORT_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    if not x_archive_token or not hmac.compare_digest(x_archive_token, ARCHIVE_EXPORT_TOKEN):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid export token")
+
+    query = {}
+    if since or until:
+        query["ended_at"] = {}
+        if since:
+            query["ended_at"]["$gte"] = since
+        if until:
+            query["ended_at"]["$lt"] = until
+    if user_id:
+        query["user_id"] = user_id
+    projection = None if include_transcript else {"transcript": 0}
+
+    async def lines():
+        # Read in batches, so exports of any size use constant memory
+        cursor = archive_collection.find(query, projection).sort("ended_at", 1).batch_size(ARCHIVE_EXPORT_BATCH_SIZE)
+        async for document in cursor:
+            yield archive.export_line(document, include_transcript)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+# ---------------------------
+# Conversation History
+# ---------------------------
+# Pages run newest first, through the hot session and then the archived
+# sessions by ended_at. A message's position is its index in its session's
+# transcript; the session is identified by when it started, which stays the
+# same once it is archived.
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+HISTORY_PAGE_MAX = int(os.getenv("HISTORY_PAGE_MAX", "200"))
+HISTORY_FIELDS = ("position", "session", "role", "state", "message")
+
+HISTORY_ARCHIVE_PROJECTION = {"started_at": 1, "ended_at": 1, "first_message_index": 1, "transcript": 1}
+
+def encode_history_cursor(position: dict) -> str:
+    values = dict(position)
+    for key in ("session", "ended_at"):
+        if values.get(key) is not None:
+            values[key] = values[key].isoformat()
+    if values.get("id") is not None:
+        values["id"] = str(values["id"])
+    raw = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def is_count(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+def decode_history_cursor(cursor: str) -> dict:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        for key in ("session", "ended_at"):
+            if values.get(key) is not None:
+                values[key] = datetime.fromisoformat(values[key])
+        if values.get("id") is not None:
+            values["id"] = ObjectId(values["id"])
+        if values["source"] == "hot":
+            # Hot cursors always point part way into a session
+            if "session" not in values or not is_count(values["history_start"]) or not is_count(values["before"]):
+                raise ValueError(values)
+            if values["before"] <= values["history_start"]:
+                raise ValueError(values)
+        elif values["source"] == "archive":
+            if "ended_at" not in values or (values.get("id") and values["ended_at"] is None):
+                raise ValueError(values)
+            # A position within a record needs the record
+            if "before" in values and not (values.get("id") and is_count(values["before"])):
+                raise ValueError(values)
+        else:
+            raise ValueError(values["source"])
+        return values
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+def parse_history_fields(fields: str) -> tuple:
+    if not fields:
+        return HISTORY_FIELDS
+    selected = tuple(field.strip() for field in fields.split(",") if field.strip())
+    unknown = [field for field in selected if field not in HISTORY_FIELDS]
+    if unknown or not selected:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown fields {unknown}; choose from {list(HISTORY_FIELDS)}",
+        )
+    return selected
+
+def history_item(position: int, session: datetime, message: dict, fields: tuple) -> str:
+    values = {
+        "position": position,
+        "session": session.isoformat() if session else None,
+        "role": message.get("role"),
+        "state": message.get("state"),
+        "message": message.get("message"),
+    }
+    return json.dumps({field: values[field] for field in fields}, ensure_ascii=False)
+
+async def load_hot_history(user_id: str, position: dict, limit: int) -> dict:
+    """Up to `limit` hot-session messages before the cursor, newest first, reading only that slice."""
+    projection = {"version": 1, "message_count": 1, "history_start": 1, "session_started_at": 1, "created_at": 1}
+    before = position.get("before")
+    if before is None:
+        projection["history"] = {"$slice": -limit}
+    else:
+        # history_start never changes within a session, so the cursor carries it
+        start = max(position["history_start"], before - limit)
+        projection["history"] = {"$slice": [start - position["history_start"], before - start]}
+    with metrics.span("history_load"):
+        session = await chats_collection.find_one({"user_id": user_id}, projection)
+    if session is None:
+        return {"messages": [], "next": {"source": "archive", "ended_at": None}, "version": None}
+
+    started_at = session.get("session_started_at") or session.get("created_at")
+    page = {"session": started_at, "version": f"{session['_id']}:{session.get('version')}"}
+    if before is not None and started_at != position["session"]:
+        # The session was archived since the last page; carry on in its archive record
+        with metrics.span("history_load"):
+            archived = await archive_collection.find_one(
+                {"user_id": user_id, "started_at": position["session"]}, {"ended_at": 1}
+            )
+        if archived is None:
+            # Its archive write hasn't landed; skip to the sessions before it
+            return {**page, "messages": [], "next": {"source": "archive", "ended_at": position["session"]}}
+        return {**page, "messages": [], "next": {
+            "source": "archive", "ended_at": archived["ended_at"], "id": archived["_id"], "before": before,
+        }}
+
+    history = session.get("history", [])
+    history_start = session.get("history_start", 0)
+    first = start if before is not None else session.get("message_count", len(history)) - len(history)
+    messages = [(first + i, message) for i, message in reversed(list(enumerate(history)))]
+    if first > history_start:
+        next_position = {"source": "hot", "session": started_at, "history_start": history_start, "before": first}
+    else:
+        # Archived sessions that ended no later than this one started
+        next_position = {"source": "archive", "ended_at": started_at}
+    return {**page, "messages": messages, "next": next_position}
+
+async def newest_archive_id(user_id: str):
+    with metrics.span("history_load"):
+        newest = await archive_collection.find({"user_id": user_id}, {"_id": 1}).sort(
+            [("ended_at", -1), ("_id", -1)]
+        ).limit(1).to_list(1)
+    return newest[0]["_id"] if newest else None
+
+def archive_history_query(user_id: str, position: dict) -> dict:
+    query = {"user_id": user_id}
+    if position.get("ended_at") is None:
+        return query
+    if position.get("id") is None:
+        query["ended_at"] = {"$lte": position["ended_at"]}
+    else:
+        # Keyset on (ended_at, _id); the record itself is included when part of it is left
+        op = "$lte" if position.get("before") is not None else "$lt"
+        query["$or"] = [
+            {"ended_at": {"$lt": position["ended_at"]}},
+            {"ended_at": position["ended_at"], "_id": {op: position["id"]}},
+        ]
+    return query
+
+def history_etag(*parts) -> str:
+    return '"' + hashlib.sha256("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()[:32] + '"'
+
+def etag_matches(etag: str, if_none_match: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in [candidate.removeprefix("W/") for candidate in candidates]
+
+@app.get("/history")
+async def get_history(
+    cursor: str = None,
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=HISTORY_PAGE_MAX),
+    fields: str = None,
+    if_none_match: str = Header(None),
+    current_user: dict = Depends(get_current_user),
+):
+    """A page of the user's messages, newest first; pass `next_cursor` back as `cursor` for older ones."""
+    user_id = current_user["id"]
+    selected = parse_history_fields(fields)
+    position = decode_history_cursor(cursor) if cursor else {"source": "hot"}
+
+    hot = None
+    if position["source"] == "hot":
+        hot = await load_hot_history(user_id, position, limit)
+        next_position = hot["next"]
+    else:
+        next_position = position
+    # Archive writes land in the background and /reset-chat deletes records, so
+    # a page that reads the archive also depends on its newest record
+    archive_head = None
+    if next_position["source"] == "archive" and len(hot["messages"] if hot else []) < limit:
+        archive_head = await newest_archive_id(user_id)
+    etag = history_etag(
+        user_id, cursor or "", limit, ",".join(selected), hot["version"] if hot else "archive", archive_head
+    )
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(etag, if_none_match):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    async def page():
+        nonlocal next_position
+        yield '{"messages":['
+        sent = 0
+        for message_position, message in (hot["messages"] if hot else []):
+            yield ("," if sent else "") + history_item(message_position, hot["session"], message, selected)
+            sent += 1
+
+        if next_position["source"] == "archive" and sent < limit:
+            archive_position, next_position = next_position, None
+            # Every record holds at least one message, so this is as many as the page can use
+            records = archive_collection.find(
+                archive_history_query(user_id, archive_position), HISTORY_ARCHIVE_PROJECTION
+            ).sort([("ended_at", -1), ("_id", -1)]).limit(limit - sent)
+            async for record in records:
+                messages = archive.decompress_transcript(bytes(record["transcript"]))
+                first = record.get("first_message_index", 0)
+                end = len(messages)
+                if record["_id"] == archive_position.get("id") and archive_position.get("before") is not None:
+                    end = max(0, min(end, archive_position["before"] - first))
+                take = min(limit - sent, end)
+                for i in range(end - 1, end - take - 1, -1):
+                    yield ("," if sent else "") + history_item(first + i, record.get("started_at"), messages[i], selected)
+                    sent += 1
+                if sent == limit:
+                    next_position = {"source": "archive", "ended_at": record["ended_at"], "id": record["_id"]}
+                    if end > take:
+                        next_position["before"] = first + end - take
+                    break
+
+        next_cursor = encode_history_cursor(next_position) if next_position else None
+        yield '],"next_cursor":' + json.dumps(next_cursor) + "}"
+
+    return StreamingResponse(page(), media_type="application/json", headers=headers)
+
 # ---------------------------
 # Chat Helpers for Conversation Flow
 # ---------------------------
+# Turns for the same user run one at a time within a worker; across workers the
+# session version check catches interleaved writes and the turn is retried.
+CHAT_TURN_MAX_ATTEMPTS = int(os.getenv("CHAT_TURN_MAX_ATTEMPTS", "3"))
+user_turn_locks = {}
+
+@asynccontextmanager
+async def user_turn_lock(user_id: str):
+    entry = user_turn_locks.get(user_id)
+    if entry is None:
+        entry = user_turn_locks[user_id] = {"lock": asyncio.Lock(), "waiters": 0}
+    entry["waiters"] += 1
+    try:
+        async with entry["lock"]:
+            yield
+    finally:
+        entry["waiters"] -= 1
+        if entry["waiters"] == 0:
+            del user_turn_locks[user_id]
+
+class SessionConflict(Exception):
+    """The chat session changed between loading it and writing the turn."""
+
+# Fields a chat turn reads; history is limited to the recent end of the transcript
+SESSION_PROJECTION = {
+    "state": 1,
+    "mood": 1,
+    "issue": 1,
+    "followup_count": 1,
+    "message_count": 1,
+    "completed_sessions": 1,
+    "is_returning": 1,
+    "is_new_user": 1,
+    "force_greeting": 1,
+    "context_summary": 1,
+    "summarized_through": 1,
+    "version": 1,
+    "history": {"$slice": -HISTORY_CONTEXT_MESSAGES},
+}
+
+# Sessions stored before message counting; the full history is the whole transcript
+LEGACY_SESSION_FILTER = {"$or": [
+    {"message_count": {"$exists": False}},
+    {"history_start": {"$exists": False}},
+    {"version": {"$exists": False}},
+]}
+
+async def backfill_session_counters(query: dict = None):
+    """Fill in message_count, history_start and version on sessions stored without them."""
+    return await chats_collection.update_many(
+        {**(query or {}), **LEGACY_SESSION_FILTER},
+        [{"$set": {
+            "message_count": {"$ifNull": ["$message_count", {"$size": {"$ifNull": ["$history", []]}}]},
+            "history_start": {"$ifNull": ["$history_start", 0]},
+            "version": {"$ifNull": ["$version", 0]},
+        }}],
+    )
+
 async def get_chat_session(user_id: str, username: str) -> dict:
-    # Check if this user is a completely new user (no sessions at all)
-    all_user_sessions = await chats_collection.find({"user_id": user_id}).to_list(length=1)
-    is_completely_new_user = len(all_user_sessions) == 0
-    
-    # Get current active chat session
-    chat = await chats_collection.find_one({"user_id": user_id})
-    
-    if not chat:
-        # Check if this user has had previous sessions that were completed
-        previous_sessions = await chats_collection.find(
-            {"user_id": user_id, "state": {"$ne": "greeting"}}
-        ).to_list(length=1)
-        
-        is_returning = len(previous_sessions) > 0
-        
-        chat = {
-            "user_id": user_id,
-            "username": username,
-            "state": "greeting",   # Possible states: greeting, mood, issue, followup, final
-            "mood": None,
-            "issue": None,
-            "followup_count": 0,
-            "history": [],
-            "is_returning": is_returning,
-            "is_new_user": is_completely_new_user,
-            "created_at": datetime.now(timezone.utc)
+    """Load the user's chat session in one round trip, creating it on first use."""
+    try:
+        session = await upsert_chat_session(user_id, username)
+    except DuplicateKeyError:
+        # Another request created the session first; this time the upsert finds it
+        session = await upsert_chat_session(user_id, username)
+    if "message_count" not in session or "version" not in session:
+        # Stored before warm-up got to it; the loaded history is sliced, so count the stored one
+        await backfill_session_counters({"_id": session["_id"]})
+        session = await upsert_chat_session(user_id, username)
+    return session
+
+async def upsert_chat_session(user_id: str, username: str) -> dict:
+    with metrics.span("session_load"):
+        return await chats_collection.find_one_and_update(
+            {"user_id": user_id},
+            {
+                "$setOnInsert": {
+                    "username": username,
+                    "state": "greeting",   # Possible states: greeting, mood, issue, followup, final
+                    "mood": None,
+                    "issue": None,
+                    "followup_count": 0,
+                    "history": [],
+                    "message_count": 0,
+                    "history_start": 0,
+                    "completed_sessions": 0,
+                    "is_returning": False,
+                    "is_new_user": True,
+                    "version": 0,
+                    "created_at": datetime.now(timezone.utc)
+                }
+            },
+            projection=SESSION_PROJECTION,
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+
+def session_version_filter(session: dict):
+    # Sessions created before versioning match on the field being absent
+    version = session.get("version")
+    return version if version is not None else {"$exists": False}
+
+async def update_chat_session(chat_session: dict, update_data: dict, new_messages: list = None, increments: dict = None,
+                              archive_reason: str = None):
+    """Apply all of a turn's changes in one version-checked write, raising SessionConflict if it lost."""
+    update = {"$set": dict(update_data or {})}
+    increments = dict(increments or {})
+    if new_messages:
+        increments["message_count"] = increments.get("message_count", 0) + len(new_messages)
+    document = None
+    if archive_reason:
+        # The loaded history is only the recent end, so read the stored transcript at this version
+        stored = await chats_collection.find_one({"_id": chat_session["_id"], "version": session_version_filter(chat_session)})
+        if stored is None:
+            raise SessionConflict(chat_session["_id"])
+        ended_at = datetime.now(timezone.utc)
+        document = build_pending_archive(stored, stored.get("history", []) + list(new_messages or []), archive_reason, ended_at)
+        # Positions in the emptied history carry on from the archived messages
+        history_start = update_data.get("message_count", chat_session.get("message_count", 0)) + increments.get("message_count", 0)
+        update["$set"].update({"history": [], "history_start": history_start, "session_started_at": ended_at})
+        update["$push"] = {"pending_archives": document}
+    elif new_messages:
+        # Only the turn's own messages are sent
+        update["$push"] = {"history": {"$each": new_messages}}
+    if not update["$set"]:
+        del update["$set"]
+    increments["version"] = 1
+    update["$inc"] = increments
+
+    with metrics.span("session_write"):
+        result = await chats_collection.find_one_and_update(
+            {"_id": chat_session["_id"], "version": session_version_filter(chat_session)}, update,
+            projection={"_id": 1},
+        )
+    if result is None:
+        raise SessionConflict(chat_session["_id"])
+    if document:
+        schedule_archive(document)
+
+# --- Session Archive ---
+# The write that empties a session's history also keeps the compressed
+# transcript on the session under pending_archives. It stays there until the
+# archive insert is confirmed, so a failed write or a killed worker never
+# loses it; warm-up queues whatever is still pending. The unique
+# (session_id, ended_at) index makes a repeated insert a no-op.
+# Pending archive write -> user_id
+archive_tasks = {}
+archive_stats = {"archived": 0, "failed": 0}
+
+def build_pending_archive(session: dict, messages: list, reason: str, ended_at: datetime) -> dict:
+    # ended_at is also the next session's session_started_at; /history relies on that
+    if not messages:
+        return None
+    return archive.build_archive_document(session, messages, reason, ended_at, ARCHIVE_COMPRESSION_LEVEL)
+
+def schedule_archive(document: dict):
+    task = asyncio.create_task(write_archive(document))
+    archive_tasks[task] = document["user_id"]
+    task.add_done_callback(lambda done: archive_tasks.pop(done, None))
+
+async def write_archive(document: dict):
+    for attempt in range(ARCHIVE_WRITE_ATTEMPTS):
+        try:
+            try:
+                await archive_collection.insert_one({**document, "archived_at": datetime.now(timezone.utc)})
+            except DuplicateKeyError:
+                # Written by an earlier attempt or another worker
+                pass
+            await chats_collection.update_one(
+                {"_id": document["session_id"]},
+                {"$pull": {"pending_archives": {"ended_at": document["ended_at"]}}},
+            )
+            archive_stats["archived"] += 1
+            return
+        except Exception as e:
+            print(f"Error archiving session {document['session_id']} (attempt {attempt + 1}): {e}")
+            await asyncio.sleep(2 ** attempt)
+    # Still on the session; the next warm-up tries again
+    archive_stats["failed"] += 1
+
+async def resume_pending_archives() -> int:
+    """Queue the archive writes left pending by a failure or a worker that died."""
+    count = 0
+    async for session in chats_collection.find({"pending_archives.0": {"$exists": True}}, {"pending_archives": 1}):
+        for document in session["pending_archives"]:
+            schedule_archive(document)
+            count += 1
+    return count
+
+async def drain_archive_tasks(timeout: float):
+    if archive_tasks:
+        await asyncio.wait(list(archive_tasks), timeout=timeout)
+
+async def delete_archived_history(user_id: str):
+    """Delete the user's archived transcripts, including ones still being written."""
+    pending = [task for task, owner in archive_tasks.items() if owner == user_id]
+    if pending:
+        await asyncio.wait(pending, timeout=ARCHIVE_DRAIN_SECONDS)
+    await archive_collection.delete_many({"user_id": user_id})
+
+async def archive_sessions(user_id: str, reason: str, reset_fields: dict) -> list:
+    """Reset every chat session of the user, archiving each transcript unless `reason` is None."""
+    session_ids = []
+    while True:
+        session = await chats_collection.find_one({"user_id": user_id, "_id": {"$nin": session_ids}})
+        if session is None:
+            return session_ids
+        ended_at = datetime.now(timezone.utc)
+        update = {
+            "$set": {**reset_fields, "history": [], "session_started_at": ended_at},
+            # Bump the version so turns still in flight retry against the reset session
+            "$inc": {"version": 1},
         }
-        result = await chats_collection.insert_one(chat)
-        chat["_id"] = result.inserted_id
-    
-    # Check if the chat was just created (has no history)
-    # This happens after a reset or for first-time users
-    if not chat.get("history"):
-        # Force the state to greeting to trigger the welcome message
-        if chat.get("state") != "greeting":
-            chat["state"] = "greeting"
-            await update_chat_session(user_id, {"state": "greeting"})
-    
-    return chat
+        document = build_pending_archive(session, session.get("history", []), reason, ended_at) if reason else None
+        if document:
+            update["$push"] = {"pending_archives": document}
+        result = await chats_collection.find_one_and_update(
+            {"_id": session["_id"], "version": session_version_filter(session)}, update, projection={"_id": 1},
+        )
+        if result is None:
+            # A turn wrote to the session since it was read; read it again
+            continue
+        session_ids.append(session["_id"])
+        if document:
+            schedule_archive(document)
+
+async def merge_duplicate_sessions() -> list:
+    """Keep the first chat session of each user, archiving and deleting the rest; returns the user_ids."""
+    user_ids = []
+    async for group in chats_collection.aggregate([
+        {"$group": {"_id": "$user_id", "session_ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ]):
+        user_ids.append(group["_id"])
+        # Requests load the first session in natural order, so that is the one in use
+        for session_id in group["session_ids"][1:]:
+            session = await chats_collection.find_one({"_id": session_id})
+            if session is None:
+                continue
+            documents = list(session.get("pending_archives", []))
+            document = build_pending_archive(session, session.get("history", []), "duplicate", datetime.now(timezone.utc))
+            if document:
+                documents.append(document)
+            for document in documents:
+                try:
+                    await archive_collection.insert_one({**document, "archived_at": datetime.now(timezone.utc)})
+                except DuplicateKeyError:
+                    pass
+            await chats_collection.delete_one({"_id": session_id, "version": session_version_filter(session)})
+    return user_ids
 
-async def update_chat_session(user_id: str, update_data: dict):
-    await chats_collection.update_one({"user_id": user_id}, {"$set": update_data}, upsert=True)
+async def generate_text(prompt: str, state: str, fallback: str) -> str:
+    """Get the reply for `state` from Gemini, or `fallback` if it can't be had in time.
 
-async def generate_followup_question(issue: str, mood: str, history: list) -> str:
+    Streamed replies aren't hedged, since two streams can't be merged; if one
+    fails part way, the client is told to discard it before the fallback.
+    """
+    sink = stream_sink.get()
+    deadline = LLM_STREAM_TIMEOUT_SECONDS if sink is not None else None
+    # When the first streamed chunk arrived; a long reply that starts promptly isn't a slow call
+    stream_timing = {}
+    try:
+        return await gemini_guard.call(
+            state, lambda: generate_once(prompt, state, sink, stream_timing), deadline=deadline, hedge=sink is None,
+            first_chunk_at=lambda: stream_timing.get("first_chunk_at"),
+        )
+    except llm_guard.LLMUnavailable as e:
+        print(f"Using fallback reply for {state}: {e}")
+        llm_guard.llm_fallbacks.inc(state, e.reason)
+        if sink is not None:
+            await sink.put(STREAM_RESET)
+            await sink.put(fallback)
+        return fallback
+
+async def generate_once(prompt: str, state: str, sink: asyncio.Queue = None, stream_timing: dict = None) -> str:
+    """Run a single Gemini completion without blocking the event loop.
+
+    `state` is the conversation state the reply is for, used to label metrics.
+    """
+    metrics.llm_calls.inc(state)
+    metrics.llm_prompt_chars.inc(state, amount=len(prompt))
+    timeout = gemini_guard.deadline_for(state) if sink is None else LLM_STREAM_TIMEOUT_SECONDS
+    started = time.perf_counter()
+    try:
+        async with llm_semaphore:
+            llm_stats["in_flight"] += 1
+            try:
+                with metrics.span("llm"):
+                    if sink is not None:
+                        text = await stream_text(prompt, sink, stream_timing)
+                    else:
+                        response = await model.generate_content_async(prompt, request_options={"timeout": timeout})
+                        text = response.text.strip()
+            finally:
+                llm_stats["in_flight"] -= 1
+    except Exception as e:
+        metrics.llm_errors.inc(state, type(e).__name__)
+        raise
+    finally:
+        metrics.llm_seconds.observe(time.perf_counter() - started, state)
+    metrics.llm_response_chars.inc(state, amount=len(text))
+    return text
+
+async def stream_text(prompt: str, sink: asyncio.Queue, stream_timing: dict = None) -> str:
+    """Forward Gemini chunks to the sink and return the full completion."""
+    response = await model.generate_content_async(
+        prompt, stream=True, request_options={"timeout": LLM_STREAM_TIMEOUT_SECONDS}
+    )
+    parts = []
+    async for chunk in response:
+        text = chunk.text
+        if text:
+            if stream_timing is not None:
+                stream_timing.setdefault("first_chunk_at", time.perf_counter())
+            parts.append(text)
+            await sink.put(text)
+    return "".join(parts).strip()
+
+# --- Prompt Context ---
+# Prompts get the last few messages verbatim plus a rolling summary of older
+# ones. The summary is extended as messages age out of the verbatim window and
+# stored on the session, so it is never rebuilt from the full transcript.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+CONTEXT_RECENT_MESSAGES = int(os.getenv("CONTEXT_RECENT_MESSAGES", "8"))
+CONTEXT_SUMMARY_TOKENS = int(os.getenv("CONTEXT_SUMMARY_TOKENS", "400"))
+CONTEXT_SUMMARY_LINE_CHARS = 160
+# Scripted bot messages that add nothing to the prompt
+CONTEXT_SKIPPED_STATES = {"greeting", "issue_prompt"}
+
+def estimate_tokens(text: str) -> int:
+    # Gemini averages roughly four characters per token for English text
+    return (len(text) + 3) // 4
+
+def render_message(message: dict, max_chars: int = None) -> str:
+    speaker = "User" if message.get("role") == "user" else "Therapist"
+    text = " ".join(str(message.get("message", "")).split())
+    if max_chars and len(text) > max_chars:
+        text = text[:max_chars - 3].rstrip() + "..."
+    return f"{speaker}: {text}"
+
+def build_prompt_context(chat_session: dict, history: list, history_offset: int, token_budget: int = None) -> dict:
+    """Render bounded conversation context for an LLM prompt.
+
+    `history_offset` is the position of history[0] in the full transcript.
+    Returns the rendered text, its token counts, and the summary fields to
+    save with the turn.
+    """
+    token_budget = token_budget or CONTEXT_TOKEN_BUDGET
+    summary_lines = list(chat_session.get("context_summary") or [])
+    summarized_through = chat_session.get("summarized_through", 0)
+
+    messages = [
+        (history_offset + i, message)
+        for i, message in enumerate(history)
+        if not (message.get("role") == "bot" and message.get("state") in CONTEXT_SKIPPED_STATES)
+    ]
+
+    def fold(position, message):
+        nonlocal summarized_through
+        if position >= summarized_through:
+            summary_lines.append(render_message(message, CONTEXT_SUMMARY_LINE_CHARS))
+            summarized_through = position + 1
+
+    # Fold messages that have aged out of the verbatim window into the summary
+    recent_start = max(0, len(messages) - CONTEXT_RECENT_MESSAGES)
+    for position, message in messages[:recent_start]:
+        fold(position, message)
+    # Anything already summarized is never repeated verbatim
+    recent = [(position, message) for position, message in messages[recent_start:] if position >= summarized_through]
+    recent_lines = [render_message(message) for _, message in recent]
+
+    # The summary gets at most half the budget, dropping its oldest lines first
+    summary_budget = min(CONTEXT_SUMMARY_TOKENS, token_budget // 2)
+
+    def summary_size():
+        while summary_lines and estimate_tokens("\n".join(summary_lines)) > summary_budget:
+            summary_lines.pop(0)
+        return estimate_tokens("\n".join(summary_lines))
+
+    # Then fold verbatim messages until the whole context fits
+    summary_tokens = summary_size()
+    while len(recent_lines) > 1 and summary_tokens + estimate_tokens("\n".join(recent_lines)) > token_budget:
+        fold(*recent.pop(0))
+        recent_lines.pop(0)
+        summary_tokens = summary_size()
+    if recent_lines and summary_tokens + estimate_tokens("\n".join(recent_lines)) > token_budget:
+        # A single message longer than the budget is cut down
+        recent_lines[-1] = recent_lines[-1][:(token_budget - summary_tokens) * 4]
+
+    recent_text = "\n".join(recent_lines)
+    parts = []
+    if summary_lines:
+        parts.append("Earlier in the conversation:\n" + "\n".join(summary_lines))
+    if recent_lines:
+        parts.append("Most recent messages:\n" + recent_text)
+    text = "\n\n".join(parts)
+
+    token_counts = {
+        "summary": summary_tokens,
+        "recent": estimate_tokens(recent_text),
+        "total": estimate_tokens(text),
+    }
+    return {
+        "text": text,
+        "tokens": token_counts,
+        "session_update": {
+            "context_summary": summary_lines,
+            "summarized_through": summarized_through,
+            "context_tokens": token_counts,
+        },
+    }
+
+async def generate_followup_question(issue: str, mood: str, context: str, followup_count: int = 0) -> str:
     prompt = (
         f"You are a highly empathetic virtual therapist. The user is feeling {mood} and is dealing with the issue: '{issue}'. "
-        f"The conversation history so far is: {history}. "
+        f"The conversation so far:\n{context}\n\n"
         f"Continue the conversation in a gentle, supportive, and very polite way. Instead of asking direct questions, use statements or gentle reflections that encourage the user to share more, as a real therapist would. Do not use question marks. Do not thank the user for sharing. Respond as if you are sympathizing and inviting them to open up further."
     )
-    response = model.generate_content(prompt)
-    return response.text.strip()
+    return await generate_text(prompt, "followup", llm_guard.fallback_response("followup", followup_count))
 
-async def generate_final_solution(history: list) -> str:
-    try:
-        prompt = (f"You are a virtual therapist. Based on the following conversation history, "
-                    f"provide a final summary and practical suggestions to help the user: {history},"
-                    f"also make sure the formatting is correct of the response")
-        
-        response = model.generate_content(prompt)
-        return response.text.strip()
-    except Exception as e:
-        print(f"Error generating final solution: {e}")
-        # Return a fallback solution to avoid rendering errors
-        return "Thank you for sharing your thoughts with me. Here's a summary of our conversation and some practical suggestions that might help you move forward."
+async def generate_final_solution(context: str) -> str:
+    prompt = (f"You are a virtual therapist. Based on the following conversation, "
+                f"provide a final summary and practical suggestions to help the user:\n{context}\n\n"
+                f"Also make sure the formatting is correct of the response")
+    # A fallback solution is returned on failure to avoid rendering errors
+    return await generate_text(prompt, "final", llm_guard.fallback_response("final"))
  
 # ---------------------------
 # Chat Endpoint: Conversation Flow
@@ -317,20 +1389,112 @@ async def generate_final_solution(history: list) -> str:
 def root():
     return {"message": "Hello Humans"}
 
+@app.get("/ready")
+def ready():
+    """Readiness probe: 200 once warm-up has finished, 503 until then."""
+    return JSONResponse(readiness, status_code=200 if readiness["ready"] else 503)
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def process_chat_turn(chat: ChatMessage, current_user: dict) -> dict:
+    """Run a turn under the user's lock, retrying if the session changed underneath it."""
+    async with user_turn_lock(current_user["id"]):
+        for attempt in range(CHAT_TURN_MAX_ATTEMPTS):
+            try:
+                return await run_chat_turn(chat, current_user)
+            except SessionConflict:
+                print(f"Chat session conflict for user {current_user['id']}, attempt {attempt + 1}")
+                sink = stream_sink.get()
+                if sink is not None:
+                    await sink.put(STREAM_RESET)
+    raise HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail="Your conversation was updated elsewhere, please send your message again",
+    )
+
+async def admit_chat_turn(current_user: dict = Depends(get_current_user)) -> dict:
+    """get_current_user for chat turns, refusing with 429 once a rate limit is used up."""
+    try:
+        await chat_admission.admit(current_user["id"])
+    except ratelimit.RateLimited as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="You're sending messages faster than I can answer, please wait a moment",
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
+        )
+    except Exception as e:
+        # A broken rate-limit store shouldn't take chat down with it
+        print(f"Error checking rate limits: {e}")
+    return current_user
+
 @app.post("/chat")
-async def chat_handler(chat: ChatMessage, current_user: dict = Depends(get_current_user)):
+async def chat_handler(chat: ChatMessage, current_user: dict = Depends(admit_chat_turn)):
+    return await process_chat_turn(chat, current_user)
+
+@app.post("/chat/stream")
+async def chat_stream_handler(chat: ChatMessage, current_user: dict = Depends(admit_chat_turn)):
+    """Same conversation flow as /chat, sent as server-sent events."""
+    queue = asyncio.Queue()
+
+    async def run_turn():
+        stream_sink.set(queue)
+        try:
+            return await process_chat_turn(chat, current_user)
+        finally:
+            await queue.put(None)
+
+    # Own task, so history is still written if the client disconnects mid-stream
+    task = asyncio.create_task(run_turn())
+
+    async def event_stream():
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            if chunk is STREAM_RESET:
+                # The turn is being retried; clients discard the text streamed so far
+                yield sse_event("reset", {})
+                continue
+            yield sse_event("chunk", {"text": chunk})
+        try:
+            result = await task
+        except HTTPException as e:
+            error = {"detail": e.detail}
+            if e.headers and "Retry-After" in e.headers:
+                error["retry_after"] = int(e.headers["Retry-After"])
+            yield sse_event("error", error)
+            return
+        except Exception as e:
+            print(f"Error streaming chat turn: {e}")
+            yield sse_event("error", {"detail": "Unable to complete this message. Please try again."})
+            return
+        yield sse_event("done", result)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+async def run_chat_turn(chat: ChatMessage, current_user: dict) -> dict:
     user_id = current_user["id"]
     username = current_user["name"]
     
-    # Check if user has previous completed chat sessions (returning user)
-    previous_sessions = await chats_collection.find(
-        {"user_id": user_id, "state": {"$ne": "greeting"}}
-    ).to_list(length=100)
-    
-    is_returning_user = len(previous_sessions) > 0
-    
     # Get or create the current chat session
     chat_session = await get_chat_session(user_id, username)
+    history = chat_session.get("history", [])
+    message_count = chat_session["message_count"]
+    # Corrections made while loading are written together with the turn's own update
+    session_fixes = {}
+    
+    # Returning users have finished a session before or are part-way through one
+    is_returning_user = chat_session.get("completed_sessions", 0) > 0 or chat_session.get("state", "greeting") != "greeting"
+    
+    # A session with no messages yet (just created or reset) always starts with the greeting
+    if message_count == 0 and chat_session.get("state") != "greeting":
+        chat_session["state"] = "greeting"
+        session_fixes["state"] = "greeting"
     
     # Check if we should force a greeting (user just logged in)
     force_greeting = chat_session.get("force_greeting", False)
@@ -339,15 +1503,26 @@ async def chat_handler(chat: ChatMessage, current_user: dict = Depends(get_curre
     if force_greeting:
         chat_session["state"] = "greeting"
         # Clear the force_greeting flag so it only happens once
-        await update_chat_session(user_id, {"force_greeting": False})
+        session_fixes["force_greeting"] = False
     
     # Always reset to greeting state for a new session if the user is returning
-    if is_returning_user and chat_session.get("state") == "greeting" and not chat_session.get("history"):
-        await update_chat_session(user_id, {"state": "greeting", "is_returning": True})
+    if is_returning_user and chat_session.get("state") == "greeting" and message_count == 0:
+        session_fixes.update({"state": "greeting", "is_returning": True})
         chat_session["is_returning"] = True
     
     state = chat_session.get("state", "greeting")
-    history = chat_session.get("history", [])
+    # Shed turns that would wait on a Gemini slot rather than queue until their deadline
+    if state in LLM_TURN_STATES and llm_stats["in_flight"] >= LLM_MAX_CONCURRENCY:
+        ratelimit.admission_rejections.inc("llm_busy")
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="I'm talking with a lot of people right now, please try again in a moment",
+            headers={"Retry-After": str(LLM_BUSY_RETRY_AFTER_SECONDS)},
+        )
+    # Messages before this index are already stored; only the rest get appended
+    history_start = len(history)
+    # Position of history[0] in the full stored transcript
+    history_offset = message_count - len(history)
     
     # State: Greeting – if no message is provided or force_greeting is True, greet the user
     if state == "greeting" and (force_greeting or chat.message is None or (chat.message and chat.message.strip() == "")):
@@ -358,16 +1533,23 @@ async def chat_handler(chat: ChatMessage, current_user: dict = Depends(get_curre
         else:
             greeting_msg = f"Hey {username}, How are you feeling today?"
         
-        # Create a new history if force_greeting is True
-        if force_greeting:
-            history = []
-            
-        history.append({"role": "bot", "state": "greeting", "message": greeting_msg})
+        greeting = {"role": "bot", "state": "greeting", "message": greeting_msg}
         
         # Critical change: DON'T update state to mood yet
         # Keep it in greeting state until the user responds with their mood
         # Only update the history, not the state
-        await update_chat_session(user_id, {"history": history})
+        if force_greeting:
+            # Start a new history if force_greeting is True
+            await update_chat_session(chat_session, {
+                **session_fixes,
+                "history": [greeting],
+                "message_count": 1,
+                "history_start": 0,
+                "context_summary": [],
+                "summarized_through": 0
+            })
+        else:
+            await update_chat_session(chat_session, session_fixes, new_messages=[greeting])
         return {"message": greeting_msg}
     
     # State: Greeting with user response – transition to mood state
@@ -377,34 +1559,24 @@ async def chat_handler(chat: ChatMessage, current_user: dict = Depends(get_curre
         history.append({"role": "user", "state": "greeting_response", "message": user_response})
         
         # Now perform sentiment analysis as we move to mood state
-        sentiment_scores = sia.polarity_scores(user_response)
-        mood = "neutral"
-        if sentiment_scores["compound"] >= 0.05:
-            mood = "positive"
-        elif sentiment_scores["compound"] <= -0.05:
-            mood = "negative"
+        mood = detect_mood(user_response)
              
         mood_msg = f"I see you're feeling {mood}. Can you please share what is bothering you today?"
         history.append({"role": "bot", "state": "issue_prompt", "message": mood_msg})
         
         # Now transition to issue state
-        await update_chat_session(user_id, {"state": "issue", "mood": mood, "history": history})
+        await update_chat_session(chat_session, {**session_fixes, "state": "issue", "mood": mood}, new_messages=history[history_start:])
         return {"message": mood_msg}
     
     # State: Mood – perform sentiment analysis on user's response
     # This state is now deprecated but kept for backward compatibility
     if state == "mood":
         user_response = chat.message.strip() if chat.message else ""
-        sentiment_scores = sia.polarity_scores(user_response)
-        mood = "neutral"
-        if sentiment_scores["compound"] >= 0.05:
-            mood = "positive"
-        elif sentiment_scores["compound"] <= -0.05:
-            mood = "negative"
+        mood = detect_mood(user_response)
         history.append({"role": "user", "state": "mood", "message": user_response})
         mood_msg = f"Got it {username}, I see you're feeling {mood}. Can you please share what is bothering you today?"
         history.append({"role": "bot", "state": "issue_prompt", "message": mood_msg})
-        await update_chat_session(user_id, {"state": "issue", "mood": mood, "history": history})
+        await update_chat_session(chat_session, {**session_fixes, "state": "issue", "mood": mood}, new_messages=history[history_start:])
         return {"message": mood_msg}
     
     # State: Issue – capture user's core issue
@@ -417,10 +1589,11 @@ async def chat_handler(chat: ChatMessage, current_user: dict = Depends(get_curre
             f"Respond as a supportive virtual therapist by validating their feelings and showing empathy. "
             f"Do not offer solutions or ask follow-up questions yet. Just acknowledge and validate their experience in a warm, human way."
         )
-        response = model.generate_content(validation_prompt)
-        validation_message = response.text.strip()
+        validation_message = await generate_text(
+            validation_prompt, "empathetic_validation", llm_guard.fallback_response("empathetic_validation")
+        )
         history.append({"role": "bot", "state": "empathetic_validation", "message": validation_message})
-        await update_chat_session(user_id, {"state": "empathetic_validation", "issue": user_issue, "history": history})
+        await update_chat_session(chat_session, {**session_fixes, "state": "empathetic_validation", "issue": user_issue}, new_messages=history[history_start:])
         return {"message": validation_message}
 
     # State: Empathetic Validation – after validation, move to followup
@@ -428,9 +1601,14 @@ async def chat_handler(chat: ChatMessage, current_user: dict = Depends(get_curre
         user_response = chat.message.strip() if chat.message else ""
         history.append({"role": "user", "state": "empathetic_validation_response", "message": user_response})
         # Now proceed to followup (cross-questioning)
-        question = await generate_followup_question(chat_session.get("issue"), chat_session.get("mood"), history)
+        context = build_prompt_context(chat_session, history, history_offset)
+        question = await generate_followup_question(chat_session.get("issue"), chat_session.get("mood"), context["text"])
         history.append({"role": "bot", "state": "followup", "message": question})
-        await update_chat_session(user_id, {"state": "followup", "history": history})
+        await update_chat_session(chat_session, {
+            **session_fixes,
+            **context["session_update"],
+            "state": "followup"
+        }, new_messages=history[history_start:])
         return {"message": question}
     
     # State: Followup – iterative conversation rounds
@@ -438,19 +1616,30 @@ async def chat_handler(chat: ChatMessage, current_user: dict = Depends(get_curre
         history.append({"role": "user", "state": "followup_response", "message": chat.message.strip() if chat.message else ""})
         followup_count = chat_session.get("followup_count", 0) + 1
         if followup_count <= 3:
-            question = await generate_followup_question(chat_session.get("issue"), chat_session.get("mood"), history)
+            context = build_prompt_context(chat_session, history, history_offset)
+            question = await generate_followup_question(
+                chat_session.get("issue"), chat_session.get("mood"), context["text"], followup_count
+            )
             history.append({"role": "bot", "state": "followup", "message": question})
-            await update_chat_session(user_id, {"state": "followup", "followup_count": followup_count, "history": history})
+            await update_chat_session(chat_session, {
+                **session_fixes,
+                **context["session_update"],
+                "state": "followup",
+                "followup_count": followup_count
+            }, new_messages=history[history_start:])
             return {"message": question}
         else:
-            final_solution = await generate_final_solution(history)
+            context = build_prompt_context(chat_session, history, history_offset)
+            final_solution = await generate_final_solution(context["text"])
             history.append({"role": "bot", "state": "final", "message": final_solution})
             # When reaching final state, user is no longer a new user
-            await update_chat_session(user_id, {
+            # The finished conversation moves to the archive in the same write
+            await update_chat_session(chat_session, {
+                **session_fixes,
+                **context["session_update"],
                 "state": "final", 
-                "history": history,
                 "is_new_user": False  # Set is_new_user to False when reaching final state
-            })
+            }, new_messages=history[history_start:], increments={"completed_sessions": 1}, archive_reason="final")
             return {"message": final_solution}
     
     # State: Final – restart conversation automatically by asking for new issue
@@ -459,12 +1648,12 @@ async def chat_handler(chat: ChatMessage, current_user: dict = Depends(get_curre
         # Reset state to "issue" and reset followup count
         history.append({"role": "bot", "state": "issue_prompt", "message": restart_msg})
         # Ensure is_new_user remains False in new conversations
-        await update_chat_session(user_id, {
+        await update_chat_session(chat_session, {
+            **session_fixes,
             "state": "issue", 
             "followup_count": 0, 
-            "history": history,
             "is_new_user": False  # Maintain is_new_user as False
-        })
+        }, new_messages=history[history_start:])
         return {"message": restart_msg}
     
     return {"message": "I'm not sure how to proceed. Let's try again."}
\ No newline at end of file
@@ -0,0 +1,322 @@
+"""Lightweight in-process metrics with Prometheus text exposition.
+
+Counters and histograms are plain dicts keyed by label values, so recording
+a sample costs a dict lookup and, for histograms, a bisect over the bucket
+bounds. Each worker process keeps its own metrics; Prometheus scrapes every
+worker and aggregates.
+
+Per-request stage timings are collected with span() and returned to the
+client in a Server-Timing header by ServerTimingMiddleware.
+"""
+import bisect
+import threading
+import time
+from contextvars import ContextVar
+
+from pymongo import monitoring
+
+# Seconds; spans from sub-millisecond cache hits to a slow LLM call
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labelnames: tuple, values: tuple) -> str:
+    if not labelnames:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)) + "}"
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        # Mongo events arrive on driver threads, so updates take the lock
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def total(self) -> float:
+        return sum(self._values.values())
+
+    def collect(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (last one is +Inf), sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, *labels) -> int:
+        series = self._series.get(labels)
+        return series[2] if series else 0
+
+    def collect(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        bucket_names = self.labelnames + ("le",)
+        for labels, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_format_labels(bucket_names, labels + (_format_value(bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total!r}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+class Gauge:
+    """Read from a callback at scrape time.
+
+    The callback returns a number, or a dict of label tuple -> number. Pass
+    metric_type="counter" for totals that are kept elsewhere.
+    """
+
+    def __init__(self, name: str, documentation: str, func, labelnames: tuple = (), metric_type: str = "gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.func = func
+        self.metric_type = metric_type
+
+    def collect(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        values = self.func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._collectors = {}
+
+    def register(self, collector):
+        self._collectors[collector.name] = collector
+        return collector
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, func, labelnames: tuple = (), metric_type: str = "gauge") -> Gauge:
+        return self.register(Gauge(name, documentation, func, labelnames, metric_type))
+
+    def render(self) -> str:
+        lines = []
+        for collector in self._collectors.values():
+            try:
+                lines.extend(collector.collect())
+            except Exception as e:
+                print(f"Error collecting metric {collector.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+# ---------------------------
+# Request stage timings
+# ---------------------------
+stage_seconds = registry.histogram(
+    "chatbot_stage_duration_seconds", "Time spent in each stage of request handling.", ("stage",)
+)
+request_seconds = registry.histogram(
+    "chatbot_http_request_duration_seconds", "Time until the response headers were sent.", ("handler", "method", "status")
+)
+
+# Stage name -> seconds for the current request, read by ServerTimingMiddleware
+request_timings: ContextVar = ContextVar("request_timings", default=None)
+
+class span:
+    """Time a block, record it in the stage histogram and the Server-Timing header.
+
+        with span("llm"):
+            ...
+    """
+
+    __slots__ = ("stage", "started")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.started
+        stage_seconds.observe(elapsed, self.stage)
+        timings = request_timings.get()
+        if timings is not None:
+            timings[self.stage] = timings.get(self.stage, 0.0) + elapsed
+        return False
+
+class ServerTimingMiddleware:
+    """Pure ASGI middleware adding Server-Timing and recording request latency.
+
+    Stages still running when the headers go out (an /chat/stream reply, for
+    example) are not in the header but are still recorded in the histograms.
+    """
+
+    def __init__(self, app, header: bool = True):
+        self.app = app
+        self.header = header
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        timings = {}
+        token = request_timings.set(timings)
+        started = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                elapsed = time.perf_counter() - started
+                endpoint = scope.get("endpoint")
+                handler = endpoint.__name__ if endpoint is not None else "unmatched"
+                request_seconds.observe(elapsed, handler, scope["method"], str(message["status"]))
+                if self.header:
+                    entries = [f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in timings.items()]
+                    entries.append(f"total;dur={elapsed * 1000:.2f}")
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", ", ".join(entries).encode("latin-1")))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            request_timings.reset(token)
+
+# ---------------------------
+# LLM calls
+# ---------------------------
+llm_calls = registry.counter("chatbot_llm_calls_total", "Gemini calls by conversation state.", ("state",))
+llm_errors = registry.counter("chatbot_llm_errors_total", "Failed Gemini calls by state and error type.", ("state", "error"))
+llm_prompt_chars = registry.counter("chatbot_llm_prompt_chars_total", "Characters sent to Gemini by state.", ("state",))
+llm_response_chars = registry.counter("chatbot_llm_response_chars_total", "Characters received from Gemini by state.", ("state",))
+llm_seconds = registry.histogram("chatbot_llm_duration_seconds", "Gemini call latency by state.", ("state",))
+
+# ---------------------------
+# MongoDB commands
+# ---------------------------
+mongo_commands = registry.counter(
+    "chatbot_mongo_commands_total", "MongoDB commands sent, by command and outcome.", ("command", "outcome")
+)
+mongo_seconds = registry.histogram(
+    "chatbot_mongo_command_duration_seconds", "MongoDB command round-trip time.", ("command",)
+)
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Counts every command a client sends; pass it in event_listeners=[...]."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        mongo_commands.inc(event.command_name, "ok")
+        mongo_seconds.observe(event.duration_micros / 1e6, event.command_name)
+
+    def failed(self, event):
+        mongo_commands.inc(event.command_name, "error")
+        mongo_seconds.observe(event.duration_micros / 1e6, event.command_name)
+
+mongo_listener = MongoCommandMetrics()
+
+# ---------------------------
+# MongoDB connection pool
+# ---------------------------
+mongo_pool_checkout_seconds = registry.histogram(
+    "chatbot_mongo_pool_checkout_duration_seconds", "Time spent waiting for a pooled connection.", ("outcome",)
+)
+
+class MongoPoolMetrics(monitoring.ConnectionPoolListener):
+    """Tracks open, checked-out and waiting connections per server.
+
+    Pass it in event_listeners=[...]; the gauges are registered by whoever
+    knows the configured pool size.
+    """
+
+    def __init__(self):
+        # address -> {"open", "checked_out", "waiting"}
+        self.pools = {}
+        self._lock = threading.Lock()
+
+    def _adjust(self, address, field: str, delta: int):
+        key = f"{address[0]}:{address[1]}"
+        with self._lock:
+            pool = self.pools.setdefault(key, {"open": 0, "checked_out": 0, "waiting": 0})
+            pool[field] += delta
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {address: dict(pool) for address, pool in self.pools.items()}
+
+    def pool_created(self, event):
+        self._adjust(event.address, "open", 0)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        with self._lock:
+            self.pools.pop(f"{event.address[0]}:{event.address[1]}", None)
+
+    def connection_created(self, event):
+        self._adjust(event.address, "open", 1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._adjust(event.address, "open", -1)
+
+    def connection_check_out_started(self, event):
+        self._adjust(event.address, "waiting", 1)
+
+    def connection_check_out_failed(self, event):
+        self._adjust(event.address, "waiting", -1)
+        mongo_pool_checkout_seconds.observe(event.duration or 0.0, "failed")
+
+    def connection_checked_out(self, event):
+        self._adjust(event.address, "waiting", -1)
+        self._adjust(event.address, "checked_out", 1)
+        mongo_pool_checkout_seconds.observe(event.duration or 0.0, "ok")
+
+    def connection_checked_in(self, event):
+        self._adjust(event.address, "checked_out", -1)
+
+mongo_pool_listener = MongoPoolMetrics()
@@ -0,0 +1,23 @@
+"""Password hashing run inside the bcrypt process pool.
+
+Kept apart from main4 so spawned workers import passlib only, not the app,
+its database clients or the Gemini SDK.
+"""
+import os
+from passlib.context import CryptContext
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__rounds=int(os.getenv("BCRYPT_ROUNDS", "12")),
+)
+
+def hash_password(password: str):
+    return pwd_context.hash(password)
+
+def verify_password(plain_password, hashed_password):
+    return pwd_context.verify(plain_password, hashed_password)
+
+def ping():
+    """No-op used to start the worker processes ahead of the first login."""
+    return os.getpid()
@@ -0,0 +1,141 @@
+"""Token-bucket admission control for chat turns.
+
+Every chat turn takes a token from the user's bucket and then one from a
+global bucket shared by all users. Buckets refill continuously at `rate`
+tokens per second, up to `burst`. A turn that finds either bucket empty is
+refused with RateLimited. Its retry_after says when a token will be there,
+and callers send that back as Retry-After.
+
+Bucket state lives in a backend:
+
+    MemoryBackend    per worker; each worker enforces the limits on its own
+    MongoBackend     a shared collection, so all workers draw on the same buckets
+
+    admission = AdmissionController(MemoryBackend(), user_rate=1 / 3, user_burst=10,
+                                    global_rate=50, global_burst=100)
+    await admission.admit(user_id)
+"""
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import metrics
+
+class RateLimited(Exception):
+    """A bucket had no token; `scope` is "user" or "global"."""
+
+    def __init__(self, scope: str, retry_after: float):
+        super().__init__(f"{scope} rate limit, retry after {retry_after:.1f}s")
+        self.scope = scope
+        self.retry_after = retry_after
+
+def refill(tokens: float, updated_at: float, now: float, rate: float, burst: float) -> float:
+    return min(burst, tokens + max(0.0, now - updated_at) * rate)
+
+class MemoryBackend:
+    """Buckets in a dict, for a single worker.
+
+    Least recently used buckets are dropped past `max_keys`; a dropped bucket
+    comes back full, which only ever errs towards letting a turn through.
+    """
+
+    def __init__(self, max_keys: int = 100000, clock=time.monotonic):
+        self.max_keys = max_keys
+        self.clock = clock
+        # key -> (tokens, updated_at)
+        self._buckets = OrderedDict()
+
+    async def take(self, key: str, rate: float, burst: float, cost: float = 1) -> float:
+        """Take `cost` tokens. Returns 0 if they were taken, otherwise the
+        seconds until they will be available."""
+        now = self.clock()
+        tokens, updated_at = self._buckets.pop(key, (burst, now))
+        tokens = refill(tokens, updated_at, now, rate, burst)
+        wait = 0.0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            wait = (cost - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return wait
+
+class MongoBackend:
+    """Buckets as documents in a collection, shared by every worker.
+
+    Each take is a single update pipeline that refills and takes in one
+    atomic step, so concurrent workers never have to retry. Documents expire
+    (with a TTL index on expires_at) once their bucket would have refilled,
+    so idle users cost nothing.
+    """
+
+    def __init__(self, collection, clock=time.time):
+        self.collection = collection
+        self.clock = clock
+
+    async def take(self, key: str, rate: float, burst: float, cost: float = 1) -> float:
+        now = self.clock()
+        elapsed = {"$max": [0, {"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}]}
+        pipeline = [
+            {"$set": {
+                "tokens": {"$min": [burst, {"$add": [{"$ifNull": ["$tokens", burst]}, {"$multiply": [elapsed, rate]}]}]},
+                "updated_at": now,
+            }},
+            {"$set": {"granted": {"$gte": ["$tokens", cost]}}},
+            {"$set": {
+                "tokens": {"$cond": ["$granted", {"$subtract": ["$tokens", cost]}, "$tokens"]},
+                "expires_at": datetime.now(timezone.utc) + timedelta(seconds=burst / rate),
+            }},
+        ]
+        for attempt in range(2):
+            try:
+                bucket = await self.collection.find_one_and_update(
+                    {"_id": key}, pipeline, projection={"tokens": 1, "granted": 1},
+                    upsert=True, return_document=ReturnDocument.AFTER,
+                )
+                break
+            except DuplicateKeyError:
+                # Two first takes raced to create the bucket; the loser updates the winner's
+                if attempt:
+                    raise
+        if bucket["granted"]:
+            return 0.0
+        return (cost - bucket["tokens"]) / rate
+
+# ---------------------------
+# Metrics
+# ---------------------------
+admission_rejections = metrics.registry.counter(
+    "chatbot_admission_rejections_total", "Chat turns refused with 429, by reason.", ("reason",)
+)
+
+class AdmissionController:
+    """Per-user and global token buckets; a rate of 0 turns that bucket off."""
+
+    def __init__(self, backend, user_rate: float, user_burst: float, global_rate: float, global_burst: float):
+        self.backend = backend
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+
+    async def admit(self, user_id: str):
+        """Take a token from the user's bucket and the global one, or raise RateLimited.
+
+        The user's bucket goes first, so a single client over its limit
+        doesn't use up the global budget.
+        """
+        if self.user_rate > 0:
+            wait = await self.backend.take(f"user:{user_id}", self.user_rate, self.user_burst)
+            if wait:
+                admission_rejections.inc("user")
+                raise RateLimited("user", wait)
+        if self.global_rate > 0:
+            wait = await self.backend.take("global", self.global_rate, self.global_burst)
+            if wait:
+                admission_rejections.inc("global")
+                raise RateLimited("global", wait)
@@ -0,0 +1,203 @@
+"""VADER sentiment analysis backed by a packaged lexicon.
+
+The lexicon ships pre-parsed in data/vader_lexicon.bin, so workers start
+without nltk.download() or any network access. Loading unpacks it straight
+into a dict without parsing text; each worker keeps its own copy, which is
+under a megabyte.
+
+Rebuild the lexicon file from a VADER lexicon text file with:
+
+    python sentiment.py build path/to/vader_lexicon.txt
+
+SentimentEngine turns text into the chatbot's positive/neutral/negative mood
+labels. It gives the same labels as thresholding NLTK's polarity_scores()
+compound score, but skips the work that only the pos/neu/neg proportions
+need. It also memoises repeated short replies and scores batches with NumPy.
+"""
+import functools
+import math
+import mmap
+import os
+import string
+import struct
+import sys
+
+import numpy as np
+
+from nltk.sentiment.vader import SentimentIntensityAnalyzer, VaderConstants
+
+LEXICON_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "vader_lexicon.bin")
+
+# File layout: header, `count` little-endian float64 valences, then the
+# newline-joined UTF-8 words in the same order
+_MAGIC = b"VADR"
+_HEADER = struct.Struct("<4sII")  # magic, entry count, size of the word block
+
+def build_lexicon(source_path: str, dest_path: str = LEXICON_PATH):
+    """Convert a tab-separated VADER lexicon into the packaged binary form."""
+    words = []
+    values = []
+    with open(source_path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            # Same parsing as SentimentIntensityAnalyzer.make_lex_dict
+            word, measure = line.split("\t")[0:2]
+            words.append(word)
+            values.append(float(measure))
+
+    word_block = "\n".join(words).encode("utf-8")
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    with open(dest_path, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, len(words), len(word_block)))
+        f.write(struct.pack(f"<{len(values)}d", *values))
+        f.write(word_block)
+    return len(words)
+
+def load_lexicon(path: str = LEXICON_PATH) -> dict:
+    # The mapping is only a read buffer here; nothing stays mapped after loading
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        magic, count, word_size = _HEADER.unpack_from(buf, 0)
+        if magic != _MAGIC:
+            raise ValueError(f"{path} is not a packaged VADER lexicon")
+        values = struct.unpack_from(f"<{count}d", buf, _HEADER.size)
+        words_start = _HEADER.size + 8 * count
+        words = buf[words_start:words_start + word_size].decode("utf-8").split("\n")
+    return dict(zip(words, values))
+
+# Compound score cut-offs for the mood labels
+POSITIVE_THRESHOLD = 0.05
+NEGATIVE_THRESHOLD = -0.05
+# VaderConstants.normalize() alpha
+NORMALIZE_ALPHA = 15
+
+def mood_from_compound(compound: float) -> str:
+    if compound >= POSITIVE_THRESHOLD:
+        return "positive"
+    if compound <= NEGATIVE_THRESHOLD:
+        return "negative"
+    return "neutral"
+
+class PackagedSentimentAnalyzer(SentimentIntensityAnalyzer):
+    """SentimentIntensityAnalyzer that takes an already parsed lexicon."""
+
+    def __init__(self, lexicon: dict = None):
+        self.lexicon = lexicon if lexicon is not None else load_lexicon()
+        self.constants = VaderConstants()
+
+class _Tokens:
+    """The two SentiText attributes sentiment_valence() reads."""
+
+    __slots__ = ("words_and_emoticons", "is_cap_diff")
+
+    def __init__(self, words_and_emoticons, is_cap_diff):
+        self.words_and_emoticons = words_and_emoticons
+        self.is_cap_diff = is_cap_diff
+
+class SentimentEngine(PackagedSentimentAnalyzer):
+    """Mood labelling on top of VADER, for single messages and bulk scoring."""
+
+    def __init__(self, lexicon: dict = None, memo_size: int = 4096):
+        super().__init__(lexicon)
+        self._punctuation = frozenset(string.punctuation)
+        self._punc_list = frozenset(self.constants.PUNC_LIST)
+        self._boosters = self.constants.BOOSTER_DICT
+        # Replies like "fine" or "not good" repeat constantly
+        self.mood = functools.lru_cache(maxsize=memo_size)(self._mood)
+
+    def tokenize(self, text: str) -> list:
+        """Same output as SentiText.words_and_emoticons, in linear time.
+
+        SentiText builds every (punctuation, word) combination to strip one
+        leading or trailing punctuation mark. Here each token is checked
+        directly instead.
+        """
+        no_punc_words = {w for w in self.constants.REGEX_REMOVE_PUNCTUATION.sub("", text).split() if len(w) > 1}
+        tokens = []
+        for token in text.split():
+            if len(token) <= 1:
+                continue
+            start = 0
+            while start < len(token) and token[start] in self._punctuation:
+                start += 1
+            end = len(token)
+            while end > start and token[end - 1] in self._punctuation:
+                end -= 1
+            leading, word, trailing = token[:start], token[start:end], token[end:]
+            if word in no_punc_words and bool(leading) != bool(trailing) and (leading or trailing) in self._punc_list:
+                token = word
+            tokens.append(token)
+        return tokens
+
+    def valence_sum(self, text: str) -> float:
+        """VADER's summed valence with punctuation emphasis, before normalising."""
+        words = self.tokenize(text)
+        if not words:
+            return 0.0
+        allcaps = sum(1 for w in words if w.isupper())
+        tokens = _Tokens(words, 0 < len(words) - allcaps < len(words))
+
+        # polarity_scores() looks each word up with list.index(), so repeated
+        # words are scored at their first position; keep that behaviour
+        first_index = {}
+        for i, word in enumerate(words):
+            first_index.setdefault(word, i)
+
+        sentiments = []
+        last = len(words) - 1
+        for item in words:
+            i = first_index[item]
+            lowered = item.lower()
+            if (i < last and lowered == "kind" and words[i + 1].lower() == "of") or lowered in self._boosters:
+                sentiments.append(0)
+                continue
+            sentiments = self.sentiment_valence(0, tokens, item, i, sentiments)
+        sentiments = self._but_check(words, sentiments)
+
+        sum_s = float(sum(sentiments))
+        punct_emph_amplifier = self._amplify_ep(text) + self._amplify_qm(text)
+        if sum_s > 0:
+            sum_s += punct_emph_amplifier
+        elif sum_s < 0:
+            sum_s -= punct_emph_amplifier
+        return sum_s
+
+    def compound(self, text: str) -> float:
+        sum_s = self.valence_sum(text)
+        return round(sum_s / math.sqrt(sum_s * sum_s + NORMALIZE_ALPHA), 4)
+
+    def _mood(self, text: str) -> str:
+        return mood_from_compound(self.compound(text))
+
+    def moods(self, texts) -> list:
+        """Label many texts at once; duplicates are only scored once."""
+        texts = list(texts)
+        positions = {}
+        unique = []
+        for text in texts:
+            if text not in positions:
+                positions[text] = len(unique)
+                unique.append(text)
+
+        sums = np.fromiter((self.valence_sum(t) for t in unique), dtype=np.float64, count=len(unique))
+        compounds = sums / np.sqrt(sums * sums + NORMALIZE_ALPHA)
+        rounded = np.round(compounds, 4)
+        labels = np.where(
+            rounded >= POSITIVE_THRESHOLD, "positive",
+            np.where(rounded <= NEGATIVE_THRESHOLD, "negative", "neutral"),
+        ).astype(object)
+
+        # np.round can disagree with round() on the last digit right at the
+        # cut-offs; settle those few with the exact scalar path
+        near = np.abs(np.abs(compounds) - 0.04995) < 1e-9
+        for i in np.flatnonzero(near):
+            labels[i] = mood_from_compound(round(float(compounds[i]), 4))
+
+        return [labels[positions[text]] for text in texts]
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "build":
+        sys.exit("usage: python sentiment.py build path/to/vader_lexicon.txt")
+    count = build_lexicon(sys.argv[2])
+    print(f"Wrote {count} entries to {LEXICON_PATH}")
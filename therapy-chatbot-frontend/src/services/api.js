@@ -91,6 +91,64 @@ export const sendMessage = async (message) => {
   }
 };
 
+// Streaming variant of sendMessage using the /chat/stream server-sent events.
+// onChunk receives each piece of text as it arrives and onReset is called when
+// the server retries the turn, so text rendered so far should be cleared. The
+// resolved value is the final message, which should replace the streamed text.
+export const streamMessage = async (message, onChunk, onReset) => {
+  const token = localStorage.getItem('token');
+  const response = await fetch(`${API_BASE_URL}/chat/stream`, {
+    method: 'POST',
+    credentials: 'include',
+    headers: {
+      'Accept': 'text/event-stream',
+      'Content-Type': 'application/json',
+      ...(token ? { Authorization: `Bearer ${token}` } : {})
+    },
+    body: JSON.stringify({ message })
+  });
+
+  if (!response.ok || !response.body) {
+    throw new Error(`Chat stream failed with status ${response.status}`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    // Events are separated by a blank line
+    let boundary = buffer.indexOf('\n\n');
+    while (boundary !== -1) {
+      const rawEvent = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      boundary = buffer.indexOf('\n\n');
+
+      const eventLine = rawEvent.split('\n').find((line) => line.startsWith('event: '));
+      const dataLine = rawEvent.split('\n').find((line) => line.startsWith('data: '));
+      if (!eventLine || !dataLine) continue;
+
+      const event = eventLine.slice('event: '.length);
+      const data = JSON.parse(dataLine.slice('data: '.length));
+      if (event === 'chunk' && onChunk) {
+        onChunk(data.text);
+      } else if (event === 'reset' && onReset) {
+        onReset();
+      } else if (event === 'done') {
+        return data.message;
+      } else if (event === 'error') {
+        throw new Error(data.detail);
+      }
+    }
+  }
+
+  throw new Error('Chat stream ended before the message was complete');
+};
+
 export const resetChat = async () => {
   return api.post('/reset-chat');
 };